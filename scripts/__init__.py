@@ -1,5 +1,11 @@
-from .parts import PartCreator
+try:
+    from .parts import PartCreator, DirectPartCreator
+except ImportError: # FreeCAD modules are only available inside a FreeCAD session
+    PartCreator = None
+    DirectPartCreator = None
 from .voxels import VoxelConverter
-from .utils import SurfaceMap
+from .raster import FeatureRasterizer
+from .transaction import SampleTransaction
+from .utils import SurfaceMap, SampleAllocator, MeshArchiver, PipelineStage
 from .utils import get_next_filenames, get_next_stl_filename, select_feature_combinations
 from .macro import *
\ No newline at end of file
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import h5py
+import trimesh
+import numpy as np
+from scipy.ndimage import binary_fill_holes, binary_erosion
+from .macro import *
+from .planner import plan_sample
+from .utils import SurfaceMap
+from .voxels import VoxelConverter, voxelize_mesh, pad_to_resolution, feature_bounds
+from .raster import FeatureRasterizer
+from .storage import SequenceWriter, SequenceReader, downsample_frames
+from .rotations import LEGACY_ROTATIONS, rotate_frames
+
+DEFAULT_THRESHOLD = 0.25 # Allowed slowdown of the median time relative to the baseline (0.25: 25% slower)
+CODECS = [('gzip', 'dense'), ('lzf', 'dense'), ('none', 'dense'), ('gzip', 'packed'), ('gzip', 'sparse')]
+
+def time_call(func, repeat=5, number=1, setup=None):
+    # Minimum and median time of one call over repeat runs of number calls, after one warm-up call;
+    # setup runs before each run and is not timed
+    if setup is not None:
+        setup()
+    func()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeat': repeat, 'number': number}
+
+def get_mesh_fixtures():
+    # Deterministic trimesh primitives in the size range of the raw stocks, centered like the parts
+    return {
+        'box': trimesh.creation.box((100, 90, 60)),
+        'cylinder': trimesh.creation.cylinder(radius=40, height=80, sections=64),
+        'sphere': trimesh.creation.icosphere(subdivisions=4, radius=50),
+        'annulus': trimesh.creation.annulus(r_min=20, r_max=50, height=60, sections=64),
+    }
+
+def get_sequence_fixture(resolution, seed=0):
+    # Voxel sequence of a planned sample, rasterized without FreeCAD
+    stock, feature_list, _, _ = plan_sample(rng=random.Random(seed))
+    frames, operations = FeatureRasterizer(resolution).rasterize_sequence(*stock, feature_list)
+    return stock, feature_list, frames, operations
+
+def grid_to_mesh(grid, origin):
+    # Closed mesh of the voxel faces of grid, shifted by -origin; voxelizes back to the same grid
+    padded = np.pad(grid, 1)
+    vertices, faces = [], []
+    for axis in range(3):
+        b, c = (axis + 1) % 3, (axis + 2) % 3
+        for step in [1, -1]:
+            # Faces towards an empty neighbour, as quads wound to point out of the solid
+            exposed = grid & ~np.roll(padded, -step, axis=axis)[1:-1, 1:-1, 1:-1]
+            index = np.argwhere(exposed).astype(float)
+            index[:, axis] += step > 0
+            corners = [(0, 0), (1, 0), (1, 1), (0, 1)] if step > 0 else [(0, 0), (0, 1), (1, 1), (1, 0)]
+            quads = np.repeat(index[:, None, :], 4, axis=1)
+            for n, (db, dc) in enumerate(corners):
+                quads[:, n, b] += db
+                quads[:, n, c] += dc
+            ids = sum(len(v) for v in vertices) + 4 * np.arange(len(index))[:, None]
+            faces += [ids + [0, 1, 2], ids + [0, 2, 3]]
+            vertices.append(quads.reshape(-1, 3))
+    return trimesh.Trimesh(np.concatenate(vertices) - origin, np.concatenate(faces))
+
+def get_machining_fixture(stock, feature_list, frames):
+    # Raw stock and part after the first feature of a sequence fixture as meshes centered like the parts,
+    # with the bounds of that feature
+    origin = np.argwhere(frames[0]).min(axis=0) + np.array(stock) / 2
+    bounds = feature_bounds(feature_list[0][0], feature_list[0][1], *stock)
+    return grid_to_mesh(frames[0], origin), grid_to_mesh(frames[0] & ~frames[1], origin), bounds
+
+def get_surface_fixture(seed=0):
+    # Top face of a raw stock with a few occupied regions, like the maps of the planner
+    rng = random.Random(seed)
+    surface = SurfaceMap(120, 100)
+    for _ in range(6):
+        i, j = rng.randrange(0, 100), rng.randrange(0, 80)
+        surface[i:i + 20, j:j + 20] = True
+    return surface
+
+def run_benchmarks(repeat=5, resolution=VOL_DIM, seed=0, only=None):
+    # Time every stage in isolation; only is a list of substrings selecting the benchmarks to run
+    resolution = np.array([resolution] * 3)
+    results = {}
+
+    def add(name, func, number=1, setup=None):
+        if only and not any(pattern in name for pattern in only):
+            return
+        results[name] = time_call(func, repeat, number, setup)
+        print(f"{name}: {1000 * results[name]['median']:.2f} ms", file=sys.stderr)
+
+    # Planning and placement queries
+    rngs = [random.Random(seed + k) for k in range(20)]
+    add('planning', lambda: [plan_sample(rng=rng) for rng in rngs]) # 20 samples per call
+    surface = get_surface_fixture(seed)
+    add('surface_map_update', lambda: (surface.__setitem__((slice(40, 60), slice(30, 50)), True), surface.flush()), number=20) # Write and table update
+    add('surface_map_rebuild', lambda: surface.update_table(40, 30), number=20) # Reference for the incremental update
+    add('surface_map_region_sum', lambda: surface.region_sum(10, 100, 10, 90), number=20)
+    add('surface_map_region_max', lambda: surface.region_max(10, 100, 10, 90), number=20) # O(area), no table
+    add('surface_map_free_windows', lambda: surface.free_windows(20, 15, margin=5), number=20)
+    rng = random.Random(seed)
+    add('surface_map_sample_window', lambda: surface.sample_window(20, 15, rng, margin=5), number=20)
+
+    # Voxelization of the mesh fixtures
+    meshes = get_mesh_fixtures()
+    grids = {}
+    for name, mesh in meshes.items():
+        grids[name] = voxelize_mesh(mesh)
+        add(f'voxelize_{name}', lambda mesh=mesh: voxelize_mesh(mesh))
+    stock, feature_list, frames, operations = get_sequence_fixture(resolution, seed)
+    converter = VoxelConverter(filename=None, stl_filename=None, voxel_resolution=resolution)
+    stock_mesh, machined_mesh, bounds = get_machining_fixture(stock, feature_list, frames)
+
+    def convert_stock():
+        # New sample with the raw stock voxelized, so every run starts from the same grid and an empty writer
+        converter.reset(None, None)
+        converter.convert_to_voxels(stock_mesh)
+
+    def convert_region():
+        converter.convert_to_voxels(machined_mesh, bounds=bounds)
+        converter.compute_delta_volume()
+        assert converter.region is not None, "the region fixture fell back to a full voxelization"
+    add('voxelize_region', convert_region, setup=convert_stock)
+    shell = grids['box'] & ~binary_erosion(grids['box'])
+    add('fill_holes', lambda: binary_fill_holes(shell))
+
+    # Grid operations of a step
+    grid = grids['box']
+    out = np.zeros(tuple(resolution), dtype=bool)
+    add('pad', lambda: pad_to_resolution(grid, resolution))
+    add('pad_out', lambda: pad_to_resolution(grid, resolution, out=out))
+    last_voxels, voxels = frames[0], frames[0] & ~frames[1]
+    add('delta_xor', lambda: np.logical_xor(last_voxels, voxels, out=out))
+
+    # HDF5 write and read of the sequence for each codec
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        for compression, storage in CODECS:
+            filename = os.path.join(tmp_dir, f'{compression}_{storage}.h5')
+            writer = SequenceWriter(compression=compression, storage=storage)
+            writer.write(filename, frames, operations) # The read benchmark needs the file even when the write one is not run
+            add(f'hdf5_write_{compression}_{storage}', lambda writer=writer, filename=filename: writer.write(filename, frames, operations))
+            if f'hdf5_write_{compression}_{storage}' in results:
+                results[f'hdf5_write_{compression}_{storage}']['bytes'] = os.path.getsize(filename)
+
+            def read(filename=filename):
+                with SequenceReader(filename) as reader:
+                    reader.read_batch()
+            add(f'hdf5_read_{compression}_{storage}', read)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Pyramid levels of the sequence (64^3 and 32^3)
+    for mode in ['any', 'fraction']:
+        add(f'pyramid_{mode}', lambda mode=mode: [downsample_frames(frames, factor, mode) for factor in [2, 4]])
+
+    # Augmentation of the whole sequence with the legacy rotations
+    add('augmentation', lambda: [np.ascontiguousarray(rotate_frames(frames, rotation)) for rotation in LEGACY_ROTATIONS])
+    return results
+
+def get_metadata(repeat, resolution, seed):
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'trimesh': trimesh.__version__,
+        'h5py': h5py.__version__,
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'resolution': resolution,
+        'seed': seed,
+    }
+
+def compare_with_baseline(results, baseline, threshold=DEFAULT_THRESHOLD, thresholds=None):
+    # Ratio of the median times to the baseline results and whether it exceeds the allowed slowdown;
+    # thresholds overrides the threshold of single benchmarks
+    thresholds = thresholds if thresholds is not None else {}
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / max(baseline[name]['median'], 1e-12)
+        limit = thresholds.get(name, threshold)
+        comparison[name] = {'ratio': ratio, 'threshold': limit, 'regression': bool(ratio > 1 + limit)}
+    return comparison
+
+def parse_thresholds(values):
+    # name=value pairs of the command line
+    thresholds = {}
+    for value in values:
+        name, _, limit = value.partition('=')
+        thresholds[name] = float(limit)
+    return thresholds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the stages of the data generation on synthetic fixtures (no FreeCAD needed).")
+    parser.add_argument('--output', default=None, help="JSON file for the results (printed when not given)")
+    parser.add_argument('--baseline', default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown against the baseline")
+    parser.add_argument('--thresholds', nargs='+', default=[], help="Allowed slowdown of single benchmarks as name=value")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--resolution', type=int, default=VOL_DIM)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', default=None, help="Run the benchmarks whose name contains any of these strings")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        # Read before the suite runs so that a wrong path fails at once
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    report = {'metadata': get_metadata(args.repeat, args.resolution, args.seed),
+              'results': run_benchmarks(args.repeat, args.resolution, args.seed, args.only)}
+    regressions = []
+    if baseline is not None:
+        report['comparison'] = compare_with_baseline(report['results'], baseline, args.threshold, parse_thresholds(args.thresholds))
+        regressions = [name for name, comparison in report['comparison'].items() if comparison['regression']]
+        for name in regressions:
+            comparison = report['comparison'][name]
+            print(f"Regression in {name}: {comparison['ratio']:.2f}x the baseline (allowed {1 + comparison['threshold']:.2f}x)", file=sys.stderr)
+        report['regressions'] = regressions
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
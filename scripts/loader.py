@@ -0,0 +1,181 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from .macro import *
+from .storage import SequenceReader
+from .shards import ShardReader, list_sample_files
+
+# State of a loader worker process: the shared batch buffers and the open shard reader
+worker_state = {}
+
+def get_buffers(buffer, shape, dtype=bool):
+    # (slots, B, T, X, Y, Z) frames view of a shared memory block
+    return np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+
+def init_worker(buffer_name, shape, dtype, shard_dir, level):
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    worker_state['buffer'] = buffer
+    worker_state['frames'] = get_buffers(buffer, shape, dtype)
+    worker_state['shards'] = ShardReader(shard_dir) if shard_dir is not None else None
+    worker_state['level'] = level
+
+def read_sample(frames, shards, item, level=1):
+    # Read the frames of an item into frames[:T] and return its operations; item is a sample id of the shards or
+    # a (file, orientation) pair of the seq_h5 tree
+    if shards is not None:
+        length = shards.lengths[shards.positions[int(item)]]
+        if length > len(frames):
+            raise ValueError(f"Sample {item} has {length} frames, more than the {len(frames)} of the batch.")
+        return shards.get(item, out=frames[:length])[1]
+    filename, orientation = item
+    with SequenceReader(filename, orientation=orientation, level=level) as reader:
+        if len(reader) > len(frames):
+            raise ValueError(f"{filename} has {len(reader)} frames, more than the {len(frames)} of the batch.")
+        reader.read_batch(out=frames[:len(reader)])
+        return reader.operations
+
+def load_sample(slot, row, item):
+    # Worker task: fill one row of a batch slot in shared memory
+    return read_sample(worker_state['frames'][slot, row], worker_state['shards'], item, worker_state['level'])
+
+class SequenceLoader:
+    def __init__(self, base_h5_dir=None, shard_dir=None, batch_size=4, max_len=MAX_TOTAL_LEN, shuffle=True, seed=0,
+                 num_workers=4, prefetch=2, drop_last=False, orientations=False, frame_shape=None, level=1):
+        # Stream batches (B, max_len, X, Y, Z) of the sequences of a seq_h5 tree or a shard directory.
+        # The frames are read by num_workers processes straight into prefetch preallocated batch slots in shared
+        # memory; a yielded batch is a view of its slot, valid until the next batch is requested. The padding after
+        # the T frames of a sequence is not written: mask[b, t] is True for the frames of the sequence and the
+        # padded operations are EOS_IDX. orientations=True also yields the rotations stored in the files (virtual
+        # augmentation). level reads only a pyramid level of the files (e.g. 2 for 64^3, see SequenceWriter).
+        # With num_workers=0 the samples are read in the calling process
+        if (base_h5_dir is None) == (shard_dir is None):
+            raise ValueError("Give either base_h5_dir or shard_dir.")
+        if shard_dir is not None and level != 1:
+            raise ValueError("The shards do not store pyramid levels.")
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.max_len = max_len
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.drop_last = drop_last
+        self.level = level
+
+        # Index of the items: sample ids of the shards or (file, orientation) pairs of the tree
+        self.shards = ShardReader(shard_dir) if shard_dir is not None else None
+        if self.shards is not None:
+            self.items = [int(sample_id) for sample_id in self.shards.sample_ids]
+        else:
+            self.items = []
+            for filename in list_sample_files(base_h5_dir):
+                if orientations:
+                    with SequenceReader(filename) as reader:
+                        self.items.extend((filename, code) for code in reader.orientations)
+                else:
+                    self.items.append((filename, 0))
+        self.dtype = bool
+        if frame_shape is None:
+            frame_shape = tuple(n // level for n in (VOL_DIM, VOL_DIM, VOL_DIM))
+            if self.items:
+                frame_shape, self.dtype = self.read_frame_format(self.items[0])
+        elif self.items:
+            self.dtype = self.read_frame_format(self.items[0])[1]
+        self.frame_shape = tuple(frame_shape)
+
+        # Batch slots; only the frames live in shared memory, the operations are sent back by the workers
+        self.shape = (self.prefetch, batch_size, max_len) + self.frame_shape
+        self.buffer = None
+        self.executor = None
+        if num_workers > 0:
+            self.buffer = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize)
+            self.frames = get_buffers(self.buffer, self.shape, self.dtype)
+            self.executor = ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                                                initargs=(self.buffer.name, self.shape, self.dtype, shard_dir, level))
+        else:
+            self.frames = np.zeros(self.shape, dtype=self.dtype)
+        self.operations = np.full((self.prefetch, batch_size, max_len), EOS_IDX, dtype=np.int64)
+        self.mask = np.zeros((self.prefetch, batch_size, max_len), dtype=bool)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.items) // self.batch_size
+        return (len(self.items) + self.batch_size - 1) // self.batch_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_frame_format(self, item):
+        # Frame shape and dtype of the batches
+        if self.shards is not None:
+            return self.shards.get(item)[0].shape[1:], bool
+        with SequenceReader(item[0], orientation=item[1], level=self.level) as reader:
+            return reader.shape, reader.dtype
+
+    def get_order(self):
+        # Item order of the current epoch; the shuffle is a permutation of the index drawn from (seed, epoch)
+        if self.shuffle:
+            return np.random.default_rng([self.seed, self.epoch]).permutation(len(self.items))
+        return np.arange(len(self.items))
+
+    def submit(self, slot, items):
+        # Start filling a slot with the given items; returns the pending reads
+        if self.executor is None:
+            return [read_sample(self.frames[slot, row], self.shards, item, self.level) for row, item in enumerate(items)]
+        return [self.executor.submit(load_sample, slot, row, item) for row, item in enumerate(items)]
+
+    def collect(self, slot, reads):
+        # Wait for the reads of a slot and build its operations and mask
+        self.operations[slot] = EOS_IDX
+        self.mask[slot] = False
+        for row, read in enumerate(reads):
+            operations = read.result() if self.executor is not None else read
+            self.operations[slot, row, :len(operations)] = operations
+            self.mask[slot, row, :len(operations)] = True
+        size = len(reads)
+        return self.frames[slot, :size], self.operations[slot, :size], self.mask[slot, :size]
+
+    def __iter__(self):
+        # Yield (frames, operations, mask) batches; every iteration is a new epoch with its own order
+        order = self.get_order()
+        self.epoch += 1
+        batches = [[self.items[k] for k in order[start:start + self.batch_size]] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        pending = {}
+        try:
+            for k in range(min(self.prefetch, len(batches))):
+                pending[k] = self.submit(k % self.prefetch, batches[k])
+            for k in range(len(batches)):
+                slot = k % self.prefetch
+                batch = self.collect(slot, pending.pop(k))
+                yield batch
+                # The consumer is done with the previous batch, so its slot can be refilled
+                if k + self.prefetch < len(batches):
+                    pending[k + self.prefetch] = self.submit(slot, batches[k + self.prefetch])
+        finally:
+            # Wait for the reads of an interrupted epoch so they do not write into the next one
+            for reads in pending.values():
+                for read in reads:
+                    if self.executor is not None and not read.cancel():
+                        read.exception()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.buffer is not None:
+            del self.frames
+            try:
+                self.buffer.close()
+            except BufferError: # A yielded batch is still referenced; the mapping goes away with it
+                pass
+            self.buffer.unlink()
+            self.buffer = None
+        if self.shards is not None:
+            self.shards.close()
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import traceback
+import numpy as np
+from .telemetry import Telemetry, set_telemetry
+
+TASK_FILE_ENV = 'VOXELSEQ_TASK_FILE'
+DEFAULT_COMMAND = ['FreeCADCmd', 'generate_data.FCMacro']
+
+def get_sample_seed(base_seed, sample, attempt=0):
+    # Seed of one sample attempt, derived from the run seed so any sample can be regenerated on its own
+    return int(np.random.SeedSequence([base_seed, sample, attempt]).generate_state(1)[0])
+
+def seed_sample(seed):
+    # The generator draws from the global random and np.random states
+    random.seed(seed)
+    np.random.seed(seed)
+
+def read_manifest(run_dir):
+    # Latest record of every sample over the append-only manifests of all the workers
+    records = {}
+    if not os.path.exists(run_dir):
+        return records
+    for manifest in sorted(f for f in os.listdir(run_dir) if f.startswith('manifest_') and f.endswith('.jsonl')):
+        with open(os.path.join(run_dir, manifest)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # Last line of a worker killed while writing
+                    continue
+                records[record['sample']] = record
+    return records
+
+class Orchestrator:
+    def __init__(self, run_dir, num_samples, num_workers=None, base_seed=0, command=None, max_attempts=10, retry_failed=True,
+                 output_dir=None, plan_manifest=None):
+        # Run the generator in num_workers headless processes and resume from the manifests on restart.
+        # output_dir replaces the dataset tree of the generator (output_dir/seq_h5 and output_dir/seq_stl);
+        # plan_manifest is a manifest of python -m scripts.planner the workers take the plans from
+        self.run_dir = run_dir
+        self.num_samples = num_samples
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.base_seed = base_seed
+        self.command = command if command is not None else DEFAULT_COMMAND
+        self.max_attempts = max_attempts
+        self.retry_failed = retry_failed
+        self.output_dir = output_dir
+        self.plan_manifest = os.path.abspath(plan_manifest) if plan_manifest is not None else None
+        os.makedirs(run_dir, exist_ok=True)
+
+    def pending_samples(self):
+        records = read_manifest(self.run_dir)
+        pending = []
+        for sample in range(1, self.num_samples + 1):
+            record = records.get(sample)
+            if record is None or (record['status'] == 'failed' and self.retry_failed):
+                pending.append(sample)
+        return pending
+
+    def write_task(self, worker, samples):
+        task_file = os.path.join(self.run_dir, f'task_{str(worker).zfill(3)}.json')
+        task = {
+            'worker': worker,
+            'run_dir': self.run_dir,
+            'base_seed': self.base_seed,
+            'max_attempts': self.max_attempts,
+            'samples': samples,
+            'output_dir': self.output_dir,
+            'plan_manifest': self.plan_manifest,
+        }
+        with open(task_file, 'w') as f:
+            json.dump(task, f)
+        return task_file
+
+    def run(self, samples=None, cwd=None):
+        # Distribute the pending samples (or the given ones) over the workers and wait for all of them
+        samples = self.pending_samples() if samples is None else list(samples)
+        if not samples:
+            print("All samples are done.")
+            return 0
+        num_workers = min(self.num_workers, len(samples))
+        print(f"Generating {len(samples)} samples with {num_workers} workers.")
+
+        processes = []
+        for worker in range(num_workers):
+            task_file = self.write_task(worker, samples[worker::num_workers])
+            env = dict(os.environ, **{TASK_FILE_ENV: os.path.abspath(task_file)})
+            processes.append(subprocess.Popen(self.command, cwd=cwd, env=env))
+        return_codes = [process.wait() for process in processes]
+
+        records = read_manifest(self.run_dir)
+        done = sum(1 for sample in samples if records.get(sample, {}).get('status') == 'done')
+        print(f"Done: {done}, Failed or missing: {len(samples) - done}")
+        return max(return_codes)
+
+    def regenerate(self, sample, cwd=None):
+        # Rebuild a single sample with its recorded seed in one worker. The files go to regenerate_N/output, never
+        # to the dataset tree, so debugging a sample does not add a duplicate to the training data
+        regenerate_dir = os.path.abspath(os.path.join(self.run_dir, f'regenerate_{sample}'))
+        return Orchestrator(regenerate_dir, self.num_samples, 1, self.base_seed, self.command, self.max_attempts,
+                            output_dir=os.path.join(regenerate_dir, 'output'), plan_manifest=self.plan_manifest).run([sample], cwd=cwd)
+
+def get_output_dirs(base_h5_dir, base_stl_dir, task=None):
+    # H5 and STL trees of a worker: the generator defaults unless the task overrides the output directory
+    task = get_task() if task is None else task
+    if task is None or task.get('output_dir') is None:
+        return base_h5_dir, base_stl_dir
+    return os.path.join(task['output_dir'], 'seq_h5'), os.path.join(task['output_dir'], 'seq_stl')
+
+def get_task():
+    # Task of the current worker process, or None when the generator is not run by the orchestrator
+    task_file = os.environ.get(TASK_FILE_ENV)
+    if task_file is None:
+        return None
+    with open(task_file) as f:
+        return json.load(f)
+
+def run_worker(generate_sample, task=None):
+    # Generate the samples of a task; generate_sample(sample, plan) returns True when the sample has to be repeated.
+    # plan is the (stock, feature_list) of the sample in the plan manifest of the task, or None to draw a new plan
+    from .planner import PlanManifest # The planner imports this module
+    task = get_task() if task is None else task
+    plan_manifest = PlanManifest(task['plan_manifest']) if task.get('plan_manifest') is not None else None
+    manifest = os.path.join(task['run_dir'], f"manifest_{str(task['worker']).zfill(3)}.jsonl")
+    # Stage times, loop counters and files of every sample (python -m scripts.telemetry summarizes them)
+    telemetry = set_telemetry(Telemetry(os.path.join(task['run_dir'], f"telemetry_{str(task['worker']).zfill(3)}.jsonl")))
+    try:
+        with open(manifest, 'a') as f:
+            for sample in task['samples']:
+                run_sample(generate_sample, task, sample, plan_manifest, telemetry, f)
+    finally:
+        if plan_manifest is not None:
+            plan_manifest.close()
+
+def run_sample(generate_sample, task, sample, plan_manifest, telemetry, f):
+    # Attempts of one sample until it is valid or max_attempts are used up, recorded in the worker manifest
+    start = time.time()
+    record = {'sample': sample, 'status': 'failed', 'worker': task['worker']}
+    with telemetry.sample(sample, worker=task['worker']):
+        for attempt in range(task['max_attempts']):
+            seed = get_sample_seed(task['base_seed'], sample, attempt)
+            seed_sample(seed)
+            record.update(attempt=attempt, seed=seed)
+            # The manifest plan is used by the first attempt; a rejected plan would be rejected again, so the
+            # next attempts draw new plans with their seeds
+            plan = plan_manifest.get_plan(sample) if plan_manifest is not None and attempt == 0 else None
+            try:
+                if not generate_sample(sample, plan):
+                    record['status'] = 'done'
+                    record.pop('error', None)
+                    break
+            except Exception as e:
+                # Retry with the next attempt seed; the error of the last attempt is kept in the record
+                record['error'] = traceback.format_exc(limit=5)
+                telemetry.repeat(repr(e))
+        telemetry.set(status=record['status'], attempt=record['attempt'], seed=record['seed'])
+    record['time'] = time.time() - start
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data generation in parallel worker processes.")
+    parser.add_argument('--run-dir', default='data/run')
+    parser.add_argument('--num-samples', type=int, default=30000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', type=int, default=None, help="Regenerate a single sample with its seed (into <run-dir>/regenerate_N/output)")
+    parser.add_argument('--output-dir', default=None, help="Write seq_h5 and seq_stl here instead of the generator's dataset tree")
+    parser.add_argument('--plan-manifest', default=None, help="Plan manifest (python -m scripts.planner) the workers build the samples from")
+    parser.add_argument('--command', nargs='+', default=None, help="Worker command (default: FreeCADCmd generate_data.FCMacro)")
+    args = parser.parse_args()
+
+    orchestrator = Orchestrator(args.run_dir, args.num_samples, args.workers, args.seed, args.command, output_dir=args.output_dir,
+                                plan_manifest=args.plan_manifest)
+    if args.regenerate is not None:
+        sys.exit(orchestrator.regenerate(args.regenerate))
+    sys.exit(orchestrator.run())
@@ -1,11 +1,24 @@
+import json
+import random
 import FreeCAD as App
 import PartDesign
 import Sketcher
 import Mesh
 import Part
 import FreeCAD
+import trimesh
+import numpy as np
 from FreeCAD import Vector, Rotation, Placement
 from .macro import *
+from .telemetry import timed
+
+MESH_TOLERANCE = 0.1 # Maximum deviation (mm) of the tessellation from the curved faces
+
+def shape_to_mesh(shape, tolerance=MESH_TOLERANCE):
+    # Tessellate a Part.Shape into a trimesh in memory, without the STL round trip
+    points, faces = shape.tessellate(tolerance)
+    vertices = np.array([(point.x, point.y, point.z) for point in points], dtype=np.float64)
+    return trimesh.Trimesh(vertices=vertices, faces=np.array(faces, dtype=np.int64).reshape(-1, 3), process=True)
 
 class PartCreator:
     def __init__(self):
@@ -14,6 +27,7 @@ class PartCreator:
         self.body = self.doc.addObject('PartDesign::Body', 'Body')
         self.doc.recompute()
 
+    @timed('cad')
     def create_raw_stock(self, length, width, height):
         self.length = length
         self.width = width
@@ -109,6 +123,7 @@ class PartCreator:
         self.datum_plane_front = datum_plane_front
         self.datum_plane_left = datum_plane_left
 
+    @timed('cad')
     def create_feature(self, feature_type, *args):
         # Generate the feature based on the feature type
         if feature_type == MILL_IDX:
@@ -290,6 +305,7 @@ class PartCreator:
         self.doc.recompute()
    
 
+    @timed('stl')
     def save_as_stl(self, file_path):
         __objs__ = [self.body]
         if hasattr(Mesh, "exportOptions"):
@@ -300,9 +316,151 @@ class PartCreator:
             
         del __objs__
 
+    @timed('mesh')
+    def to_mesh(self, tolerance=MESH_TOLERANCE):
+        return shape_to_mesh(self.body.Shape, tolerance)
+
     def close_document(self):
         App.closeDocument(App.ActiveDocument.Name)
 
         
 
+class DirectPartCreator:
+    def __init__(self):
+        # Same interface as PartCreator, but the features are applied as boolean cuts of primitive solids on a single
+        # shape, without sketches, solver runs or feature-tree recomputes
+        App.newDocument("Unnamed")
+        self.doc = App.ActiveDocument
+        self.body = self.doc.addObject('Part::Feature', 'Body') # Holds the current shape for the mesh export
+        self.shape = None
+
+    @timed('cad')
+    def create_raw_stock(self, length, width, height):
+        self.length = length
+        self.width = width
+        self.height = height
+
+        # Centered box, like the midplane Pad of the PartDesign path (top face at z = height/2)
+        self.shape = Part.makeBox(length, width, int(height), Vector(-length/2, -width/2, -int(height)/2))
+        self.body.Shape = self.shape
+
+    @timed('cad')
+    def create_feature(self, feature_type, *args):
+        if self.shape is None:
+            raise ValueError("Raw stock must be created before the features.")
+
+        # Generate the feature based on the feature type
+        if feature_type == MILL_IDX:
+            tool = self.create_mill_feature(*args)
+        elif feature_type == DRILL_IDX:
+            tool = self.create_drill_feature(*args)
+        elif feature_type == SLANT_IDX:
+            tool = self.create_slant_feature(*args)
+        else:
+            raise ValueError("Invalid feature type")
+        self.shape = self.shape.cut(tool)
+        self.body.Shape = self.shape
+
+    def create_mill_feature(self, length, width, depth, x, y):
+        # Tool of the rectangular pocket; it goes 1 mm past the top face to avoid coplanar faces in the cut
+        return Part.makeBox(length, width, int(depth) + 1, Vector(x - length/2, y - width/2, self.height/2 - int(depth)))
+
+    def create_drill_feature(self, diameter, depth, x, y):
+        # Tool of the hole, also 1 mm past the top face
+        return Part.makeCylinder(diameter / 2, int(depth) + 1, Vector(x, y, self.height/2 - int(depth)), Vector(0, 0, 1))
+
+    def create_slant_feature(self, direction, size_slant, height_slant):
+        # Triangular prism along the top edge of the given side, extruded 1 mm past both ends of the edge
+        top = self.height/2
+        if direction == 'left':
+            points = [Vector(-self.length/2, -self.width/2 - 1, top), Vector(-self.length/2, -self.width/2 - 1, top - height_slant),
+                      Vector(-self.length/2 + size_slant, -self.width/2 - 1, top)]
+            extrusion = Vector(0, int(self.width) + 2, 0)
+        elif direction == 'right':
+            points = [Vector(self.length/2, -self.width/2 - 1, top), Vector(self.length/2, -self.width/2 - 1, top - height_slant),
+                      Vector(self.length/2 - size_slant, -self.width/2 - 1, top)]
+            extrusion = Vector(0, int(self.width) + 2, 0)
+        elif direction == 'top':
+            points = [Vector(-self.length/2 - 1, self.width/2, top), Vector(-self.length/2 - 1, self.width/2, top - height_slant),
+                      Vector(-self.length/2 - 1, self.width/2 - size_slant, top)]
+            extrusion = Vector(int(self.length) + 2, 0, 0)
+        elif direction == 'bottom':
+            points = [Vector(-self.length/2 - 1, -self.width/2, top), Vector(-self.length/2 - 1, -self.width/2, top - height_slant),
+                      Vector(-self.length/2 - 1, -self.width/2 + size_slant, top)]
+            extrusion = Vector(int(self.length) + 2, 0, 0)
+        else:
+            raise ValueError("Invalid slant direction")
+        profile = Part.Face(Part.makePolygon(points + points[:1]))
+        return profile.extrude(extrusion)
+
+    @timed('stl')
+    def save_as_stl(self, file_path):
+        __objs__ = [self.body]
+        if hasattr(Mesh, "exportOptions"):
+            options = Mesh.exportOptions(file_path)
+            Mesh.export(__objs__, file_path, options)
+        else:
+            Mesh.export(__objs__, file_path)
+
+        del __objs__
 
+    @timed('mesh')
+    def to_mesh(self, tolerance=MESH_TOLERANCE):
+        return shape_to_mesh(self.shape, tolerance)
+
+    def close_document(self):
+        App.closeDocument(App.ActiveDocument.Name)
+
+def compare_backends(length, width, height, feature_list, tolerance=1e-3):
+    # Build the same sequence with PartCreator and DirectPartCreator and report the volume of the symmetric
+    # difference of the two shapes after every step
+    reference = PartCreator()
+    direct = DirectPartCreator()
+    report = []
+    try:
+        reference.create_raw_stock(length, width, height)
+        direct.create_raw_stock(length, width, height)
+        for step, feature in enumerate([None] + list(feature_list)):
+            if feature is not None:
+                reference.create_feature(feature[0], *feature[1])
+                direct.create_feature(feature[0], *feature[1])
+            reference_shape = reference.body.Shape
+            difference = reference_shape.cut(direct.shape).Volume + direct.shape.cut(reference_shape).Volume
+            report.append({
+                'step': step,
+                'operation': RS_IDX if feature is None else feature[0],
+                'reference_volume': reference_shape.Volume,
+                'direct_volume': direct.shape.Volume,
+                'difference': difference,
+                'match': difference <= tolerance,
+            })
+    finally:
+        App.closeDocument(reference.doc.Name)
+        App.closeDocument(direct.doc.Name)
+    return report
+
+def compare_planned_samples(num_samples=100, base_seed=0, first_sample=1, filename=None, tolerance=1e-3, max_attempts=10):
+    # Run compare_backends on the plans of samples first_sample..first_sample+num_samples-1 (orchestrator seeds) and
+    # save the reports as JSON. This is the evidence needed before DirectPartCreator becomes the default backend
+    # Imported here: the package imports this module, and python -m scripts.planner must not import the planner twice
+    from .planner import plan_sample, PlanningError
+    from .orchestrator import get_sample_seed
+    results = {'base_seed': base_seed, 'tolerance': tolerance, 'samples': []}
+    for sample in range(first_sample, first_sample + num_samples):
+        for attempt in range(max_attempts):
+            seed = get_sample_seed(base_seed, sample, attempt)
+            try:
+                stock, feature_list, _, case = plan_sample(random.Random(seed), sample)
+                break
+            except PlanningError:
+                continue
+        else:
+            continue
+        report = compare_backends(*stock, feature_list, tolerance)
+        results['samples'].append({'sample': sample, 'seed': seed, 'case': case, 'steps': report,
+                                   'match': all(step['match'] for step in report)})
+    results['mismatches'] = [result['sample'] for result in results['samples'] if not result['match']]
+    if filename is not None:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
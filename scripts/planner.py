@@ -0,0 +1,830 @@
+import random
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .macro import *
+from .utils import SurfaceMap, select_feature_combinations, window_any
+from .orchestrator import get_sample_seed
+from .telemetry import get_telemetry, timed
+
+MAX_RETRIES = 200 # Attempts to place a feature before the sample is reported as infeasible
+
+class PlanningError(Exception):
+    # A feature could not be placed within its retry budget; the sample has to be drawn again with another seed
+    pass
+
+def attempts(max_retries, feature):
+    # Bounded replacement of the rejection loops: the loop breaks on success, otherwise the feature is infeasible.
+    # The feature sizes differ from the old loops, see the comparison table in README (Parallel Generation)
+    for attempt in range(max_retries):
+        get_telemetry().count(feature)
+        yield attempt
+    raise PlanningError(f"No valid location for the {feature} after {max_retries} attempts.")
+
+def get_slant_depths(size_slant, height_slant):
+    # Depth of the slant at each row/column of the surface, from its edge inwards
+    return np.ceil(height_slant - np.arange(size_slant) * (height_slant / size_slant)).astype(int)
+
+@timed('plan')
+def plan_sample(rng=None, sample=None, verbose=False, max_retries=MAX_RETRIES):
+    # Draw the raw stock dimensions and the ordered feature list of a sample without building any geometry.
+    # rng is a random.Random instance; by default the global random state (seeded per sample by the orchestrator) is used
+    rng = random if rng is None else rng
+
+    # Create raw stock with random dimensions
+    length = rng.randint(100, 128)
+    width = rng.randint(100, 128)
+    height = rng.randint(50, 80)
+
+    # Initialize the occupancy maps (grids representing the top surface of the raw stock)
+    occupancy_drilling = SurfaceMap(length, width)
+    occupancy_milling = SurfaceMap(length, width)
+    occupancy_slant = SurfaceMap(length, width)
+    occupancy_depth = SurfaceMap(length, width, dtype=int)
+
+    # Initialize the lists for the features. Each feature is represented by a tuple with the following elements:
+    # (feature index, feature parameters, feature volume)
+    slant_list = []
+    mill_list = []
+    drill_list = []
+    feature_list = []
+    flag_mill_1 = False # Flag for the milling feature that doesn't intersect other milling features
+    flag_mill_2 = False # Flag for the nesting milling feature that nests another milling feature
+    flag_mill_3 = False # Flag for the nested milling feature that is nested by another milling feature
+    flag_mill_4 = False # Flag for the abut milling feature that abut the nesting milling feature
+
+    D = rng.randint(2, MAX_N_DRILL)
+    M = rng.randint(2, MAX_N_MILL)
+    create_first_type_first = rng.choice([True, False]) # For later deciding the order of the milling operation
+
+    # Place the features based on the selected combination of types of operations
+    combination, case = select_feature_combinations(rng)
+    # Place the slant feature first with its corresponding intersecting features
+    if SLANT_IDX in combination:
+        directions = ['left', 'right', 'top', 'bottom']
+        direction = rng.choice(directions)
+        size_slant = rng.randint(15, 30)
+        height_slant = rng.randint(15, 30)
+        volume_slant = 0.5 * size_slant * height_slant * width if direction in ['left', 'right'] else 0.5 * size_slant * height_slant * length
+        slant_list.append((SLANT_IDX, (direction, size_slant, height_slant), volume_slant))
+
+        if direction == 'left':
+            occupancy_slant[0:size_slant, :] = True
+            occupancy_depth[0:size_slant, :] = get_slant_depths(size_slant, height_slant)[:, None]
+
+            if case not in ["Intersection Drill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant", "Intersection Mill-Drill"]:
+                occupancy_drilling[0:size_slant, :] = True
+
+            elif case != "Intersection Mill-Drill":
+                diameter_drill = rng.randint(8, size_slant - 6)
+                length_drill = diameter_drill + 6
+                width_drill = diameter_drill + 6
+                rectification_x = rng.randint(0, size_slant - length_drill)
+                rectification_y = rng.randint(0, width - width_drill)
+                x_drill = - length/2 + length_drill/2 + rectification_x
+                y_drill = - width/2 + width_drill/2 + rectification_y
+                depth_drill = rng.randint(height_slant + 5, height)
+                volume_drill = 0.25 * np.pi * diameter_drill * diameter_drill * depth_drill
+                occupancy_depth[rectification_x+3:rectification_x+length_drill-3, rectification_y+3:rectification_y+width_drill-3] = depth_drill
+                occupancy_drilling[rectification_x:rectification_x+length_drill, rectification_y:rectification_y+width_drill] = True
+
+                drill_list.append((DRILL_IDX, (diameter_drill, depth_drill, x_drill, y_drill), volume_drill))
+                D -= 1
+
+            if case not in ["Intersection Mill-Slant", "Intersection Mill-Drill Mill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant"]:
+                occupancy_milling[0:size_slant, :] = True
+
+            else:
+                length_mill = rng.randint(size_slant, int(0.5 * length))
+                width_mill = rng.randint(10, int(0.5 * width))
+                rectification_x = 0
+                rectification_y = rng.randint(5, width - width_mill - 5)
+                max_depth = occupancy_depth.region_max(rectification_x, rectification_x+length_mill, rectification_y, rectification_y+width_mill) - 5
+                if max_depth < height_slant: max_depth = height
+                depth_mill = rng.randint(height_slant, max_depth)
+                volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=0, a_max=depth_mill))
+                x_mill = - length/2 + length_mill/2 + rectification_x
+                y_mill = - width/2 + width_mill/2 + rectification_y
+                occupancy_depth[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=depth_mill, a_max=None)
+                occupancy_milling[rectification_x:rectification_x+length_mill+5, rectification_y-5:rectification_y+width_mill+5] = True
+                if case == "Intersection Mill-Slant":
+                    occupancy_drilling[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = True
+
+                mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                M -= 1
+                flag_mill_1 = True
+
+        elif direction == 'right':
+            occupancy_slant[-size_slant:, :] = True
+            occupancy_depth[-size_slant:, :] = get_slant_depths(size_slant, height_slant)[::-1, None]
+
+            if case not in ["Intersection Drill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant", "Intersection Mill-Drill"]:
+                occupancy_drilling[-size_slant:, :] = True
+
+            elif case != "Intersection Mill-Drill":
+                diameter_drill = rng.randint(8, size_slant - 6)
+                length_drill = diameter_drill + 6
+                width_drill = diameter_drill + 6
+                rectification_x = rng.randint(length - size_slant, length - length_drill)
+                rectification_y = rng.randint(0, width - width_drill)
+                x_drill = - length/2 + length_drill/2 + rectification_x
+                y_drill = - width/2 + width_drill/2 + rectification_y
+                depth_drill = rng.randint(height_slant + 5, height)
+                volume_drill = 0.25 * np.pi * diameter_drill * diameter_drill * depth_drill
+                occupancy_depth[rectification_x+3:rectification_x+length_drill-3, rectification_y+3:rectification_y+width_drill-3] = depth_drill
+                occupancy_drilling[rectification_x:rectification_x+length_drill, rectification_y:rectification_y+width_drill] = True
+
+                drill_list.append((DRILL_IDX, (diameter_drill, depth_drill, x_drill, y_drill), volume_drill))
+                D -= 1
+
+            if case not in ["Intersection Mill-Slant", "Intersection Mill-Drill Mill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant"]:
+                occupancy_milling[-size_slant:, :] = True
+
+            else:
+                length_mill = rng.randint(size_slant, int(0.5 * length))
+                width_mill = rng.randint(10, int(0.5 * width))
+                rectification_x = length - length_mill
+                rectification_y = rng.randint(5, width - width_mill - 5)
+                max_depth = occupancy_depth.region_max(rectification_x, rectification_x+length_mill, rectification_y, rectification_y+width_mill) - 5
+                if max_depth < height_slant: max_depth = height
+                depth_mill = rng.randint(height_slant, max_depth)
+                volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=depth_mill, a_max=None))
+                x_mill = - length/2 + length_mill/2 + rectification_x
+                y_mill = - width/2 + width_mill/2 + rectification_y
+                occupancy_depth[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=depth_mill, a_max=None)
+                occupancy_milling[rectification_x-5:rectification_x+length_mill, rectification_y-5:rectification_y+width_mill+5] = True
+                if case == "Intersection Mill-Slant":
+                    occupancy_drilling[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = True
+
+                mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                M -= 1
+                flag_mill_1 = True
+
+        elif direction == 'top':
+            occupancy_slant[:, -size_slant:] = True
+            occupancy_depth[:, -size_slant:] = get_slant_depths(size_slant, height_slant)[None, ::-1]
+
+            if case not in ["Intersection Drill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant", "Intersection Mill-Drill"]:
+                occupancy_drilling[:, -size_slant:] = True
+
+            elif case != "Intersection Mill-Drill":
+                diameter_drill = rng.randint(8, size_slant - 6)
+                length_drill = diameter_drill + 6
+                width_drill = diameter_drill + 6
+                rectification_x = rng.randint(0, length - length_drill)
+                rectification_y = rng.randint(width - size_slant, width - width_drill)
+                x_drill = - length/2 + length_drill/2 + rectification_x
+                y_drill = - width/2 + width_drill/2 + rectification_y
+                depth_drill = rng.randint(height_slant + 5, height)
+                volume_drill = 0.25 * np.pi * diameter_drill * diameter_drill * depth_drill
+                occupancy_depth[rectification_x+3:rectification_x+length_drill-3, rectification_y+3:rectification_y+width_drill-3] = depth_drill
+                occupancy_drilling[rectification_x:rectification_x+length_drill, rectification_y:rectification_y+width_drill] = True
+
+                drill_list.append((DRILL_IDX, (diameter_drill, depth_drill, x_drill, y_drill), volume_drill))
+                D -= 1
+
+            if case not in ["Intersection Mill-Slant", "Intersection Mill-Drill Mill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant"]:
+                occupancy_milling[:, -size_slant:] = True
+
+            else:
+                length_mill = rng.randint(10, int(0.5 * length))
+                width_mill = rng.randint(size_slant, int(0.5 * width))
+                rectification_x = rng.randint(0, length - length_mill)
+                rectification_y = width - width_mill
+                max_depth = occupancy_depth.region_max(rectification_x, rectification_x+length_mill, rectification_y, rectification_y+width_mill) - 5
+                if max_depth < height_slant: max_depth = height
+                depth_mill = rng.randint(height_slant, max_depth)
+                volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=0, a_max=depth_mill))
+                x_mill = - length/2 + length_mill/2 + rectification_x
+                y_mill = - width/2 + width_mill/2 + rectification_y
+                occupancy_depth[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=depth_mill, a_max=None)
+                occupancy_milling[rectification_x-5:rectification_x+length_mill+5, rectification_y-5:rectification_y+width_mill] = True
+                if case == "Intersection Mill-Slant":
+                    occupancy_drilling[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = True
+
+                mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                M -= 1
+                flag_mill_1 = True
+
+        elif direction == 'bottom':
+            occupancy_slant[:, 0:size_slant] = True
+            occupancy_depth[:, 0:size_slant] = get_slant_depths(size_slant, height_slant)[None, :]
+
+            if case not in ["Intersection Drill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant", "Intersection Mill-Drill"]:
+                occupancy_drilling[:, 0:size_slant] = True
+
+            elif case != "Intersection Mill-Drill":
+                diameter_drill = rng.randint(8, size_slant - 6)
+                length_drill = diameter_drill + 6
+                width_drill = diameter_drill + 6
+                rectification_x = rng.randint(0, length - length_drill)
+                rectification_y = rng.randint(0, size_slant - width_drill)
+                x_drill = - length/2 + length_drill/2 + rectification_x
+                y_drill = - width/2 + width_drill/2 + rectification_y
+                depth_drill = rng.randint(height_slant + 5, height)
+                volume_drill = 0.25 * np.pi * diameter_drill * diameter_drill * depth_drill
+                occupancy_depth[rectification_x+3:rectification_x+length_drill-3, rectification_y+3:rectification_y+width_drill-3] = depth_drill
+                occupancy_drilling[rectification_x:rectification_x+length_drill, rectification_y:rectification_y+width_drill] = True
+
+                drill_list.append((DRILL_IDX, (diameter_drill, depth_drill, x_drill, y_drill), volume_drill))
+                D -= 1
+
+            if case not in ["Intersection Mill-Slant", "Intersection Mill-Drill Mill-Slant", "Intersection Mill-Drill Mill-Slant Drill-Slant"]:
+                occupancy_milling[:, 0:size_slant] = True
+
+            else:
+                length_mill = rng.randint(10, int(0.5 * length))
+                width_mill = rng.randint(size_slant, int(0.5 * width))
+                rectification_x = rng.randint(0, length - length_mill)
+                rectification_y = 0
+                max_depth = occupancy_depth.region_max(rectification_x, rectification_x+length_mill, rectification_y, rectification_y+width_mill) - 5
+                if max_depth < height_slant: max_depth = height
+                depth_mill = rng.randint(height_slant, max_depth)
+                volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=0, a_max=depth_mill))
+                x_mill = - length/2 + length_mill/2 + rectification_x
+                y_mill = - width/2 + width_mill/2 + rectification_y
+                occupancy_depth[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = np.clip(occupancy_depth.grid[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill], a_min=depth_mill, a_max=None)
+                occupancy_milling[rectification_x-5:rectification_x+length_mill+5, rectification_y:rectification_y+width_mill+5] = True
+                if case == "Intersection Mill-Slant":
+                    occupancy_drilling[rectification_x:rectification_x+length_mill, rectification_y:rectification_y+width_mill] = True
+
+                mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                M -= 1
+                flag_mill_1 = True
+
+
+    for operation in combination:
+
+        if operation == SLANT_IDX:
+            
+            feature_list.extend(slant_list)
+
+        if operation == DRILL_IDX:
+            
+            # Ensure that a drill is created inside a milling feature in the corresponding cases
+            if case == "Intersection Mill-Drill Mill-Slant" or case == "Intersection Mill-Drill Mill-Slant Drill-Slant" or case == "Intersection Mill-Drill":
+                # Place nesting milling feature (flag_mill_2)
+                for attempt in attempts(max_retries, "nesting milling feature"): # Iterate over the dimensions to find a suitable location for the drill
+                    length_mill = rng.randint(30, int(0.7*length))
+                    width_mill = rng.randint(30, int(0.7*width))
+
+                    # Leave space for the other milling features
+                    if case == "Intersection Mill-Drill" and (M > 2 or (M == 2 and not create_first_type_first)):
+                        if len(slant_list) > 0:
+                            if (slant_list[0][1][0] in ["left", "right"] and (length - length_mill - slant_list[0][1][1] < 40) and (width - width_mill < 40)) or \
+                                (slant_list[0][1][0] in ["top", "bottom"] and (width - width_mill - slant_list[0][1][1] < 40) and (length - length_mill < 40)):
+                                continue
+                        else:
+                            if length - length_mill < 40 or width - width_mill < 40:
+                                continue
+
+                    # Draw the location among the free ones that leave space for a minimum size drill inside the milling feature
+                    free_drills = window_any(occupancy_drilling.free_windows(14, 14), length_mill - 14 + 1, width_mill - 14 + 1)
+                    location = occupancy_milling.sample_window(length_mill, width_mill, rng, mask=free_drills,
+                                                               rows=[0, length - length_mill, *range(5, length - length_mill - 5 + 1)], # Prevent from creating thin edges
+                                                               cols=[0, width - width_mill, *range(5, width - width_mill - 5 + 1)])
+                    if location is None:
+                        continue
+                    rectification_x, rectification_y = location
+                    x_mill = - length/2 + length_mill/2 + rectification_x
+                    y_mill = - width/2 + width_mill/2 + rectification_y
+
+                    i_start_mill = rectification_x
+                    i_end_mill = rectification_x + length_mill
+                    j_start_mill = rectification_y
+                    j_end_mill = rectification_y + width_mill
+
+                    max_depth = int(0.5 * height)
+                    min_depth = 10
+                    if "depth_drill" in locals():
+                        if occupancy_depth.region_max(i_start_mill+3, i_end_mill-3, j_start_mill+3, j_end_mill-3) == depth_drill:
+                            max_depth = depth_drill - 10
+                    if occupancy_slant.is_not_free(i_start_mill, i_end_mill, j_start_mill, j_end_mill):
+                        depth_grid = occupancy_depth.grid[i_start_mill:i_end_mill, j_start_mill:j_end_mill]
+                        min_depth = max(np.max(depth_grid[depth_grid <= height_slant]) - 5, 10)
+                    if min_depth > max_depth:
+                        continue
+                    depth_mill = rng.randint(min_depth, max_depth) # lower range: 10 - (height_slant-5) upper range: (height_slant-5) - (height-10)
+
+                    # Create a drill inside the milling feature
+                    for attempt_drill in attempts(max_retries, "drill inside the nesting milling feature"): # Iterate over the dimensions to find a suitable location for the drill
+                        diameter_drill_next = rng.randint(8, min(24, int(0.5*min(length_mill, width_mill)))) # lower range: 8 upper range: 15 - 24
+                        length_drill_next = diameter_drill_next + 6
+                        width_drill_next = diameter_drill_next + 6
+                        location = occupancy_drilling.sample_window(length_drill_next, width_drill_next, rng,
+                                                                    rows=range(i_start_mill, i_end_mill - length_drill_next + 1),
+                                                                    cols=range(j_start_mill, j_end_mill - width_drill_next + 1))
+                        if location is None:
+                            continue
+                        rectification_x_drill_next, rectification_y_drill_next = location
+
+                        x_drill_next = - length/2 + length_drill_next/2 + rectification_x_drill_next
+                        y_drill_next = - width/2 + width_drill_next/2 + rectification_y_drill_next
+
+                        i_start_drill_next = rectification_x_drill_next
+                        i_end_drill_next = rectification_x_drill_next + length_drill_next
+                        j_start_drill_next = rectification_y_drill_next
+                        j_end_drill_next = rectification_y_drill_next + width_drill_next
+
+                        depth_drill_next = rng.randint(depth_mill + 10, height) # lower range: 20 - 50 upper range: 50 - 80
+                        volume_drill_next = 0.25 * np.pi * diameter_drill_next * diameter_drill_next * depth_drill_next
+                        occupancy_drilling[i_start_drill_next:i_end_drill_next, j_start_drill_next:j_end_drill_next] = True
+                        occupancy_depth[i_start_drill_next+3:i_end_drill_next-3, j_start_drill_next+3:j_end_drill_next-3] = depth_drill_next
+                        drill_list.append((DRILL_IDX, (diameter_drill_next, depth_drill_next, x_drill_next, y_drill_next), volume_drill_next))
+                        D -= 1
+                        break
+
+                    # Continue with the nesting milling feature
+                    volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[i_start_mill:i_end_mill, j_start_mill:j_end_mill], a_min=0, a_max=depth_mill))
+                    mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                    occupancy_milling[i_start_mill:i_end_mill, j_start_mill:j_end_mill] = True
+                    occupancy_depth[i_start_mill:i_end_mill, j_start_mill:j_end_mill] = np.clip(occupancy_depth.grid[i_start_mill:i_end_mill, j_start_mill:j_end_mill], a_min=depth_mill, a_max=None)
+                    M -= 1
+                    flag_mill_2 = True
+                    break
+                
+                # Place nested milling feature (flag_mill_3)
+                if (M > 0 and create_first_type_first) or (M > 1 and not create_first_type_first):
+                    for attempt in attempts(max_retries, "nested milling feature"): # Iterate over the dimensions to make the nested fature smaller than the nesting feature
+                        length_mill_next = rng.randint(diameter_drill_next + 5, length_mill) # lower range: 15 - 32 upper range: 100 - 128
+                        width_mill_next = rng.randint(diameter_drill_next + 5, width_mill) # lower range: 15 - 32 upper range: 100 - 128
+                        if length_mill_next <= length_mill - 10 or width_mill_next < width_mill - 10:
+                            break
+                    rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                    rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+                    x_mill_next = - length/2 + length_mill_next/2 + rectification_x_next
+                    y_mill_next = - width/2 + width_mill_next/2 + rectification_y_next
+
+                    i_start_mill_next = rectification_x_next
+                    i_end_mill_next = rectification_x_next + length_mill_next
+                    j_start_mill_next = rectification_y_next
+                    j_end_mill_next = rectification_y_next + width_mill_next
+
+                    max_depth = height - 5
+                    min_depth = depth_mill + 5
+                    depth_grid = occupancy_depth.grid[i_start_mill_next+3:i_end_mill_next-3, j_start_mill_next+3:j_end_mill_next-3]
+                    if "depth_drill" in locals() and"depth_drill_next" in locals():
+                        check_drill_1 = np.any(depth_grid[depth_grid > depth_mill] == depth_drill)
+                        check_drill_2 = np.any(depth_grid[depth_grid > depth_mill] == depth_drill_next)
+                        if check_drill_1 and check_drill_2:
+                            max_depth = min(depth_drill, depth_drill_next) - 5
+                        elif check_drill_1 or check_drill_2:
+                            max_depth = check_drill_1 * depth_drill + check_drill_2 * depth_drill_next - 5
+                    elif "depth_drill" in locals():
+                        if np.max(depth_grid) == depth_drill:
+                            max_depth = depth_drill - 5
+                    elif "depth_drill_next" in locals():
+                        if np.max(depth_grid) == depth_drill_next:
+                            max_depth = depth_drill_next - 5
+                    depth_mill_next = rng.randint(min_depth, max_depth) # lower range: 15 - (depth_mill + 5) upper range: (depth_mill + 5) - 75
+                    volume_mill_next = length_mill_next * width_mill_next * depth_mill_next - np.sum(np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=depth_mill, a_max=depth_mill_next))
+
+                    mill_list.append((MILL_IDX, (length_mill_next, width_mill_next, depth_mill_next, x_mill_next, y_mill_next), volume_mill_next))
+                    occupancy_depth[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=depth_mill_next, a_max=None)
+                    M -= 1
+                    flag_mill_3 = True
+
+                # Place abut milling feature (the nesting feature serve as the base feature to this abut feature)
+                if M > 0:
+                    # Iterate over the coordinates and dimensions to find a suitable location for the abut feature (next to the nesting feature)
+                    for attempt in attempts(max_retries, "abut milling feature"):
+                        direction = rng.choice(['left', 'right', 'top', 'bottom'])
+                        if direction == 'left':
+                            length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                            width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                            rectification_x_next = rectification_x - length_mill_next
+                            rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+
+                        elif direction == 'right':
+                            length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                            width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                            rectification_x_next = rectification_x + length_mill
+                            rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+
+                        elif direction == 'top':
+                            length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                            width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                            rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                            rectification_y_next = rectification_y + width_mill
+
+                        elif direction == 'bottom':
+                            length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                            width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                            rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                            rectification_y_next = rectification_y - width_mill_next
+                            
+                        x_mill_next = - length/2 + length_mill_next/2 + rectification_x_next
+                        y_mill_next = - width/2 + width_mill_next/2 + rectification_y_next
+
+                        i_start_mill_next = rectification_x_next
+                        if i_start_mill_next < 0 or i_start_mill_next in range(1, 5):  # Prevent from creating thin edges
+                            continue
+                        i_end_mill_next = rectification_x_next + length_mill_next
+                        if i_end_mill_next > length or i_end_mill_next in range(length - 5, length):  # Prevent from creating thin edges
+                            continue
+                        j_start_mill_next = rectification_y_next
+                        if j_start_mill_next < 0 or j_start_mill_next in range(1, 5):  # Prevent from creating thin edges
+                            continue
+                        j_end_mill_next = rectification_y_next + width_mill_next
+                        if j_end_mill_next > width or j_end_mill_next in range(width - 5, width):  # Prevent from creating thin edges
+                            continue
+
+                        if occupancy_milling.is_free(i_start_mill_next, i_end_mill_next, j_start_mill_next, j_end_mill_next):
+                            depth_mill_next = rng.randint(5, depth_mill - 5) # lower range: 5 upper range: 5 - 65
+                            # If the slant overlaps with the abut feature, look for another location
+                            if depth_mill_next < occupancy_depth.region_max(i_start_mill_next, i_end_mill_next, j_start_mill_next, j_end_mill_next):
+                                continue
+                            volume_mill_next = length_mill_next * width_mill_next * depth_mill_next - np.sum(np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=0, a_max=depth_mill_next))
+                            mill_list.append((MILL_IDX, (length_mill_next, width_mill_next, depth_mill_next, x_mill_next, y_mill_next), volume_mill_next))
+                            occupancy_milling[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = True
+                            occupancy_depth[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=depth_mill_next, a_max=None)
+                            M -= 1
+                            flag_mill_4 = True
+                            if flag_mill_3 and flag_mill_4:
+                                mill_list[-2:] = sorted(mill_list[-2:], key=lambda x: x[2], reverse=True)
+                            break
+            
+            # Place the drill features
+            for drill_number in range(D):
+                #Check if there is available space for a minimum size drill
+                space_available = np.any(occupancy_drilling.free_windows(14, 14))
+                if not space_available:
+                    if drill_number == 0 and verbose:
+                        print(f"Sample: {sample}, No space available for the drill")
+                    break
+
+                # Iterate over the dimensions and draw the location of the drill among the free ones
+                for attempt in range(max_retries):
+                    get_telemetry().count("drilling feature")
+                    diameter_drill = rng.randint(8, 24)
+                    length_drill = diameter_drill + 6
+                    width_drill = diameter_drill + 6
+                    location = occupancy_drilling.sample_window(length_drill, width_drill, rng)
+                    if location is None:
+                        continue
+                    rectification_x, rectification_y = location
+                    x_drill = - length/2 + length_drill/2 + rectification_x
+                    y_drill = - width/2 + width_drill/2 + rectification_y
+
+                    i_start_drill = rectification_x
+                    i_end_drill = rectification_x + length_drill
+                    j_start_drill = rectification_y
+                    j_end_drill = rectification_y + width_drill
+
+                    min_depth = max(occupancy_depth.region_max(i_start_drill, i_end_drill, j_start_drill, j_end_drill) + 5, 10)
+                    if min_depth > height:
+                        continue
+                    depth_drill = rng.randint(min_depth, height) # lower range: 10 - height upper range: heigth
+                    volume_drill = 0.25 * np.pi * diameter_drill * diameter_drill * depth_drill
+                    drill_list.append((DRILL_IDX, (diameter_drill, depth_drill, x_drill, y_drill), volume_drill))
+                    occupancy_drilling[i_start_drill:i_end_drill, j_start_drill:j_end_drill] = True
+                    occupancy_depth[i_start_drill+3:i_end_drill-3, j_start_drill+3:j_end_drill-3] = depth_drill
+                    break
+                else:
+                    # The free locations left are too shallow for a drill: keep the drills placed so far
+                    if verbose:
+                        print(f"Sample: {sample}, No valid location for drill {drill_number + 1}")
+                    break
+
+            drill_list.sort(key=lambda x: x[2], reverse=True)
+            feature_list.extend(drill_list)
+
+        # Place the milling features not placed in the previous operations
+        if operation == MILL_IDX:
+
+            # Place the nesting milling feature
+            if not flag_mill_2 and M > 0:
+                # Iterate over the dimensions and draw the location of the milling feature among the free ones
+                for attempt in attempts(max_retries, "nesting milling feature"):
+                    length_mill = rng.randint(30, int(0.7*length))
+                    width_mill = rng.randint(30, int(0.7*width))
+                    # Leave space for the other milling features
+                    if  case in ["No Intersection", "Intersection Drill-Slant"] and (M > 2 or (M == 2 and not create_first_type_first)):
+                        if len(slant_list) > 0:
+                            if M == 2:
+                                if (slant_list[0][1][0] in ["left", "right"] and (length - length_mill - slant_list[0][1][1] < 40) and (width - width_mill < 40)) or \
+                                    (slant_list[0][1][0] in ["top", "bottom"] and (width - width_mill - slant_list[0][1][1] < 40) and (length - length_mill < 40)):
+                                    continue
+                            if M > 2:
+                                if (slant_list[0][1][0] in ["left", "right"] and ((length - length_mill - slant_list[0][1][1] < 40) or (width - width_mill < 40))) or \
+                                    (slant_list[0][1][0] in ["top", "bottom"] and ((width - width_mill - slant_list[0][1][1] < 40) or (length - length_mill < 40))):
+                                    continue
+                        else:
+                            if M == 2:
+                                if length - length_mill < 40 and width - width_mill < 40:
+                                    continue
+                            if M > 2:
+                                if length - length_mill < 40 or width - width_mill < 40:
+                                    continue
+
+                    location = occupancy_milling.sample_window(length_mill, width_mill, rng,
+                                                               rows=[0, length - length_mill, *range(5, length - length_mill - 5 + 1)], # Prevent from creating thin edges
+                                                               cols=[0, width - width_mill, *range(5, width - width_mill - 5 + 1)])
+                    if location is None:
+                        continue
+                    rectification_x, rectification_y = location
+                    x_mill = - length/2 + length_mill/2 + rectification_x
+                    y_mill = - width/2 + width_mill/2 + rectification_y
+
+                    i_start_mill = rectification_x
+                    i_end_mill = rectification_x + length_mill
+                    j_start_mill = rectification_y
+                    j_end_mill = rectification_y + width_mill
+
+                    if occupancy_slant.is_not_free(i_start_mill, i_end_mill, j_start_mill, j_end_mill):
+                        min_depth = occupancy_depth.region_max(i_start_mill, i_end_mill, j_start_mill, j_end_mill) - 5
+                    else: min_depth = 15
+                    depth_mill = rng.randint(max(min_depth, 15), max(min_depth, int(0.5*height)))
+                    volume_mill = length_mill * width_mill * depth_mill - np.sum(np.clip(occupancy_depth.grid[i_start_mill:i_end_mill, j_start_mill:j_end_mill], a_min=0, a_max=depth_mill))
+                    occupancy_drilling[i_start_mill:i_end_mill, j_start_mill:j_end_mill] = True
+                    occupancy_milling[i_start_mill:i_end_mill, j_start_mill:j_end_mill] = True
+                    occupancy_depth[i_start_mill:i_end_mill, j_start_mill:j_end_mill] = np.clip(occupancy_depth.grid[i_start_mill:i_end_mill, j_start_mill:j_end_mill], a_min=depth_mill, a_max=None)
+                    mill_list.append((MILL_IDX, (length_mill, width_mill, depth_mill, x_mill, y_mill), volume_mill))
+                    M -= 1
+                    flag_mill_2 = True
+                    break
+            
+            # Place the nested milling feature
+            if not flag_mill_3 and ((M > 0 and create_first_type_first) or (M > 1 and not create_first_type_first)):
+                # Iterate over the dimensions to make the nested feature smaller than the nesting feature
+                for attempt in attempts(max_retries, "nested milling feature"):
+                    length_mill_next = rng.randint(15, length_mill)
+                    width_mill_next = rng.randint(15, width_mill)
+                    if length_mill_next < length_mill - 5 or width_mill_next < width_mill - 5:
+                        break
+                rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+                x_mill_next = - length/2 + length_mill_next/2 + rectification_x_next
+                y_mill_next = - width/2 + width_mill_next/2 + rectification_y_next
+
+                i_start_mill_next = rectification_x_next
+                i_end_mill_next = rectification_x_next + length_mill_next
+                j_start_mill_next = rectification_y_next
+                j_end_mill_next = rectification_y_next + width_mill_next
+
+                depth_mill_next = rng.randint(depth_mill + 5, min(depth_mill + 5 + int(0.3*height), height))
+                volume_mill_next = length_mill_next * width_mill_next * depth_mill_next - np.sum(np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=depth_mill, a_max=depth_mill_next))
+                occupancy_depth[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=depth_mill_next, a_max=None)
+
+                mill_list.append((MILL_IDX, (length_mill_next, width_mill_next, depth_mill_next, x_mill_next, y_mill_next), volume_mill_next))
+                M -= 1
+                flag_mill_3 = True
+
+            # Place the abut milling feature
+            if not flag_mill_4 and M > 0:
+                # Iterate over the coordinates and dimensions to find a suitable location for the abut feature
+                for attempt in attempts(max_retries, "abut milling feature"):
+                    direction = rng.choice(['left', 'right', 'top', 'bottom'])
+                    if direction == 'left':
+                        length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                        width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                        rectification_x_next = rectification_x - length_mill_next
+                        rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+
+                    elif direction == 'right':
+                        length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                        width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                        rectification_x_next = rectification_x + length_mill
+                        rectification_y_next = rng.randint(rectification_y, rectification_y + width_mill - width_mill_next)
+
+                    elif direction == 'top':
+                        length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                        width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                        rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                        rectification_y_next = rectification_y + width_mill
+
+                    elif direction == 'bottom':
+                        length_mill_next = rng.randint(15, int(0.65 * length_mill))
+                        width_mill_next = rng.randint(15, int(0.65 * width_mill))
+                        rectification_x_next = rng.randint(rectification_x, rectification_x + length_mill - length_mill_next)
+                        rectification_y_next = rectification_y - width_mill_next
+                        
+                    x_mill_next = - length/2 + length_mill_next/2 + rectification_x_next
+                    y_mill_next = - width/2 + width_mill_next/2 + rectification_y_next
+
+                    i_start_mill_next = rectification_x_next
+                    if i_start_mill_next < 0 or i_start_mill_next in range(1, 5):  # Prevent from creating thin edges
+                        continue
+                    i_end_mill_next = rectification_x_next + length_mill_next
+                    if i_end_mill_next > length or i_end_mill_next in range(length - 5, length):  # Prevent from creating thin edges
+                        continue
+                    j_start_mill_next = rectification_y_next    
+                    if j_start_mill_next < 0 or j_start_mill_next in range(1, 5):  # Prevent from creating thin edges
+                        continue
+                    j_end_mill_next = rectification_y_next + width_mill_next
+                    if j_end_mill_next > width or j_end_mill_next in range(width - 5, width):  # Prevent from creating thin edges
+                        continue
+
+                    if occupancy_milling.is_free(i_start_mill_next, i_end_mill_next, j_start_mill_next, j_end_mill_next):
+                        depth_mill_next = rng.randint(5, depth_mill - 5)
+                        # If the slant overlaps with the abut feature, look for another location
+                        if depth_mill_next < occupancy_depth.region_max(i_start_mill_next, i_end_mill_next, j_start_mill_next, j_end_mill_next): 
+                            continue
+                        occupancy_drilling[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = True
+                        occupancy_milling[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = True
+                        volume_mill_next = length_mill_next * width_mill_next * depth_mill_next - np.sum(np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=0, a_max=depth_mill_next))
+                        mill_list.append((MILL_IDX, (length_mill_next, width_mill_next, depth_mill_next, x_mill_next, y_mill_next), volume_mill_next))
+                        M -= 1
+                        flag_mill_4 = True
+                        if flag_mill_3 and flag_mill_4:
+                            mill_list[-2:] = sorted(mill_list[-2:], key=lambda x: x[2], reverse=True)
+                        break
+            
+            if not flag_mill_1 and M > 0:
+                # Iterate over the dimensions and draw the location of the milling feature among the free ones (5 voxels apart from the others)
+                for attempt in attempts(max_retries, "milling feature"):
+                    length_mill_next = rng.randint(15, int(0.5 * length))
+                    width_mill_next = rng.randint(15, int(0.5 * width))
+                    location = occupancy_milling.sample_window(length_mill_next, width_mill_next, rng, margin=5,
+                                                               rows=[0, length - length_mill_next, *range(5, length - length_mill_next - 5 + 1)], # Prevent from creating thin edges
+                                                               cols=[0, width - width_mill_next, *range(5, width - width_mill_next - 5 + 1)])
+                    if location is None:
+                        continue
+                    rectification_x_next, rectification_y_next = location
+                    x_mill_next = - length/2 + length_mill_next/2 + rectification_x_next
+                    y_mill_next = - width/2 + width_mill_next/2 + rectification_y_next
+
+                    i_start_mill_next = rectification_x_next
+                    i_end_mill_next = rectification_x_next + length_mill_next
+                    j_start_mill_next = rectification_y_next
+                    j_end_mill_next = rectification_y_next + width_mill_next
+
+                    occupancy_drilling[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = True
+                    occupancy_milling[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next] = True
+                    max_depth = occupancy_depth.region_max(i_start_mill_next, i_end_mill_next, j_start_mill_next, j_end_mill_next)
+                    if max_depth == 0:
+                        depth_mill_next = rng.randint(15, height)
+                    else:
+                        depth_mill_next = max_depth - 5
+                    volume_mill_next = length_mill_next * width_mill_next * depth_mill_next - np.sum(np.clip(occupancy_depth.grid[i_start_mill_next:i_end_mill_next, j_start_mill_next:j_end_mill_next], a_min=0, a_max=depth_mill_next))
+                    mill_list.insert(0, (MILL_IDX, (length_mill_next, width_mill_next, depth_mill_next, x_mill_next, y_mill_next), volume_mill_next))
+                    M -= 1
+                    flag_mill_1 = True
+                    break
+
+            if flag_mill_1:
+                if mill_list[0][2] <= mill_list[1][2]:
+                    mill_list.append(mill_list.pop(0))
+
+            feature_list.extend(mill_list)
+
+
+    get_telemetry().set(combination=combination, case=case)
+    return (length, width, height), feature_list, combination, case
+
+CASES = ["No Intersection", "Intersection Mill-Slant", "Intersection Drill-Slant", "Intersection Mill-Drill",
+         "Intersection Mill-Drill Mill-Slant Drill-Slant", "Intersection Mill-Drill Mill-Slant"]
+DIRECTIONS = ['left', 'right', 'top', 'bottom']
+NUM_PARAMS = 5 # Mill: (length, width, depth, x, y), Drill: (diameter, depth, x, y), Slant: (direction, size, height)
+
+def encode_features(feature_list):
+    # Feature tuples as arrays: operations (F,), parameters (F, NUM_PARAMS) padded with zeros and volumes (F,);
+    # the slant direction is stored as its index in DIRECTIONS
+    operations = np.zeros(len(feature_list), dtype=np.int8)
+    params = np.zeros((len(feature_list), NUM_PARAMS), dtype=np.float32) # Sizes are integers and positions multiples of 0.5
+    volumes = np.zeros(len(feature_list), dtype=np.float64)
+    for k, (operation, args, volume) in enumerate(feature_list):
+        if operation == SLANT_IDX:
+            args = (DIRECTIONS.index(args[0]),) + tuple(args[1:])
+        operations[k] = operation
+        params[k, :len(args)] = args
+        volumes[k] = volume
+    return operations, params, volumes
+
+def decode_features(operations, params, volumes):
+    # Inverse of encode_features; sizes and depths come back as ints and positions as floats
+    feature_list = []
+    for operation, row, volume in zip(operations, params, volumes):
+        operation = int(operation)
+        if operation == MILL_IDX:
+            args = (int(row[0]), int(row[1]), int(row[2]), float(row[3]), float(row[4]))
+        elif operation == DRILL_IDX:
+            args = (int(row[0]), int(row[1]), float(row[2]), float(row[3]))
+        else:
+            args = (DIRECTIONS[int(row[0])], int(row[1]), int(row[2]))
+        feature_list.append((operation, args, float(volume)))
+    return feature_list
+
+def plan_block(samples, base_seed=0, max_attempts=10):
+    # Plans of the given samples as manifest arrays, each drawn with the seed of the first orchestrator attempt
+    # that can be planned (infeasible plans are rerolled like in the workers)
+    seeds = np.zeros(len(samples), dtype=np.int64)
+    stocks = np.zeros((len(samples), 3), dtype=np.int16)
+    cases = np.zeros(len(samples), dtype=np.int8)
+    lengths = np.zeros(len(samples), dtype=np.int64)
+    operations, params, volumes = [], [], []
+    for k, sample in enumerate(samples):
+        for attempt in range(max_attempts):
+            seeds[k] = get_sample_seed(base_seed, sample, attempt)
+            try:
+                stocks[k], feature_list, _, case = plan_sample(random.Random(int(seeds[k])), sample)
+                break
+            except PlanningError:
+                continue
+        else:
+            raise PlanningError(f"Sample {sample} could not be planned in {max_attempts} attempts.")
+        cases[k] = CASES.index(case)
+        lengths[k] = len(feature_list)
+        encoded = encode_features(feature_list)
+        operations.append(encoded[0])
+        params.append(encoded[1])
+        volumes.append(encoded[2])
+    return (np.array(samples, dtype=np.int64), seeds, stocks, cases, lengths,
+            np.concatenate(operations), np.concatenate(params), np.concatenate(volumes))
+
+def write_plan_manifest(filename, num_plans, base_seed=0, first_sample=1, num_workers=None, block_size=10000):
+    # Plan samples first_sample..first_sample+num_plans-1 in parallel blocks and append them to one HDF5 manifest.
+    # The features of plan k are features[feature_offsets[k]:feature_offsets[k + 1]]
+    names = ['samples', 'seeds', 'stocks', 'cases', 'lengths', 'operations', 'params', 'volumes']
+    samples = list(range(first_sample, first_sample + num_plans))
+    blocks = [samples[i:i + block_size] for i in range(0, len(samples), block_size)]
+    with h5py.File(filename, 'w') as h5file:
+        h5file.attrs['base_seed'] = base_seed
+        h5file.attrs['cases'] = CASES
+        h5file.attrs['directions'] = DIRECTIONS
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Blocks are appended in order, so the manifest does not depend on the number of workers
+            for block in executor.map(plan_block, blocks, [base_seed] * len(blocks)):
+                for name, data in zip(names, block):
+                    if name not in h5file:
+                        h5file.create_dataset(name, data=data, maxshape=(None,) + data.shape[1:], chunks=True, compression='gzip')
+                    else:
+                        dataset = h5file[name]
+                        dataset.resize(dataset.shape[0] + len(data), axis=0)
+                        dataset[-len(data):] = data
+        lengths = h5file['lengths'][:] if 'lengths' in h5file else np.zeros(0, dtype=np.int64)
+        h5file.create_dataset('feature_offsets', data=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    return num_plans
+
+class PlanManifest:
+    def __init__(self, filename):
+        # Random access to the plans of a manifest; everything but the feature table is loaded in memory
+        self.h5file = h5py.File(filename, 'r')
+        self.samples = self.h5file['samples'][:] if 'samples' in self.h5file else np.zeros(0, dtype=np.int64)
+        self.seeds = self.h5file['seeds'][:] if 'seeds' in self.h5file else np.zeros(0, dtype=np.int64)
+        self.stocks = self.h5file['stocks'][:] if 'stocks' in self.h5file else np.zeros((0, 3), dtype=np.int16)
+        self.cases = self.h5file['cases'][:] if 'cases' in self.h5file else np.zeros(0, dtype=np.int8)
+        self.feature_offsets = self.h5file['feature_offsets'][:]
+        self.case_names = [str(case) for case in self.h5file.attrs['cases']]
+        self.positions = {int(sample): k for k, sample in enumerate(self.samples)}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, sample):
+        return int(sample) in self.positions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, sample):
+        # Raw stock dimensions and ordered feature list of a sample
+        k = self.positions[int(sample)]
+        start, end = self.feature_offsets[k], self.feature_offsets[k + 1]
+        feature_list = decode_features(self.h5file['operations'][start:end], self.h5file['params'][start:end], self.h5file['volumes'][start:end])
+        return tuple(int(n) for n in self.stocks[k]), feature_list
+
+    def get_plan(self, sample):
+        # Plan of a sample, or None if the manifest does not cover it (the generator then draws one)
+        return self.get(sample) if sample in self else None
+
+    def case_distribution(self):
+        # Number of plans of every feature case
+        counts = np.bincount(self.cases, minlength=len(self.case_names))
+        return {case: int(count) for case, count in zip(self.case_names, counts)}
+
+    def size_distribution(self):
+        # Percentiles of the mill and drill dimensions over all plans
+        operations, params = self.h5file['operations'][:], self.h5file['params'][:]
+        mills, drills = params[operations == MILL_IDX], params[operations == DRILL_IDX]
+        columns = {'mill length': mills[:, 0], 'mill width': mills[:, 1], 'mill depth': mills[:, 2],
+                   'drill diameter': drills[:, 0], 'drill depth': drills[:, 1]}
+        return {name: dict({f'p{p}': float(np.percentile(values, p)) for p in [10, 50, 90]}, mean=float(values.mean()))
+                for name, values in columns.items() if len(values) > 0}
+
+    def close(self):
+        self.h5file.close()
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Plan samples without building their geometry and write them to a manifest.")
+    parser.add_argument('--output', default='data/plans.h5')
+    parser.add_argument('--num-plans', type=int, default=30000)
+    parser.add_argument('--first-sample', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.time()
+    write_plan_manifest(args.output, args.num_plans, args.seed, args.first_sample, args.workers)
+    elapsed = time.time() - start
+    print(f"Planned {args.num_plans} samples in {elapsed:.1f} s ({args.num_plans / max(elapsed, 1e-9):.0f} plans/s).")
+    with PlanManifest(args.output) as manifest:
+        for case, count in manifest.case_distribution().items():
+            print(f"{case}: {count} ({100 * count / max(len(manifest), 1):.1f}%)")
+        for name, values in manifest.size_distribution().items():
+            print(f"{name}: mean {values['mean']:.1f}, p10 {values['p10']:.0f}, p50 {values['p50']:.0f}, p90 {values['p90']:.0f}")
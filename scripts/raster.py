@@ -0,0 +1,142 @@
+import numpy as np
+from .macro import *
+from .voxels import VoxelConverter, get_padding
+
+class FeatureRasterizer:
+    def __init__(self, voxel_resolution=None):
+        # Analytic counterpart of PartCreator + VoxelConverter: features are written straight to the voxel grid
+        self.voxel_resolution = voxel_resolution if voxel_resolution is not None else np.array([VOL_DIM, VOL_DIM, VOL_DIM])
+        self.voxels = None
+        self.last_voxels = None
+
+    def create_raw_stock(self, length, width, height):
+        self.length = length
+        self.width = width
+        self.height = height
+
+        # Same cropping and centering as VoxelConverter.convert_to_voxels: the part occupies int(extent) voxels
+        # per axis, padded with (resolution - extent) // 2 empty voxels before it
+        shape = (int(length), int(width), int(height))
+        extents = (length, width, height)
+        self.offsets = [before for before, _ in get_padding(shape, self.voxel_resolution)]
+
+        # Coordinates of the voxel centres in the part frame (the raw stock is centered at the origin)
+        self.centers = [np.arange(self.voxel_resolution[k]) - self.offsets[k] + 0.5 - extents[k] / 2 for k in range(3)]
+
+        self.voxels = np.zeros(tuple(self.voxel_resolution), dtype=bool)
+        self.voxels[self.offsets[0]:self.offsets[0] + shape[0],
+                    self.offsets[1]:self.offsets[1] + shape[1],
+                    self.offsets[2]:self.offsets[2] + shape[2]] = True
+        self.last_voxels = None
+
+    def create_feature(self, feature_type, *args):
+        if self.voxels is None:
+            raise ValueError("Raw stock must be created before the features.")
+        self.last_voxels = self.voxels.copy()
+
+        # Carve the feature based on the feature type
+        if feature_type == MILL_IDX:
+            self.create_mill_feature(*args)
+        elif feature_type == DRILL_IDX:
+            self.create_drill_feature(*args)
+        elif feature_type == SLANT_IDX:
+            self.create_slant_feature(*args)
+        else:
+            raise ValueError("Invalid feature type")
+
+    def _span(self, axis, start, end):
+        # Slice of the voxels whose centres lie inside [start, end) along the given axis
+        centers = self.centers[axis]
+        return slice(np.searchsorted(centers, start), np.searchsorted(centers, end))
+
+    def create_mill_feature(self, length, width, depth, x, y):
+        # Rectangular pocket from the top face
+        span_x = self._span(0, x - length/2, x + length/2)
+        span_y = self._span(1, y - width/2, y + width/2)
+        span_z = self._span(2, self.height/2 - depth, self.height/2)
+        self.voxels[span_x, span_y, span_z] = False
+
+    def create_drill_feature(self, diameter, depth, x, y):
+        # Cylindrical hole from the top face (distance test on the columns of the bounding square)
+        radius = diameter / 2
+        span_x = self._span(0, x - radius, x + radius)
+        span_y = self._span(1, y - radius, y + radius)
+        span_z = self._span(2, self.height/2 - depth, self.height/2)
+        dx = self.centers[0][span_x] - x
+        dy = self.centers[1][span_y] - y
+        disk = dx[:, None] ** 2 + dy[None, :] ** 2 <= radius ** 2
+        self.voxels[span_x, span_y, span_z] &= ~disk[:, :, None]
+
+    def create_slant_feature(self, direction, size_slant, height_slant):
+        # Triangular prism along the top edge of the given side (half-space test on the hypotenuse)
+        span_z = self._span(2, self.height/2 - height_slant, self.height/2)
+        depth = self.height/2 - self.centers[2][span_z]
+        if direction == 'left':
+            span = self._span(0, -self.length/2, -self.length/2 + size_slant)
+            distance = self.centers[0][span] + self.length/2
+        elif direction == 'right':
+            span = self._span(0, self.length/2 - size_slant, self.length/2)
+            distance = self.length/2 - self.centers[0][span]
+        elif direction == 'top':
+            span = self._span(1, self.width/2 - size_slant, self.width/2)
+            distance = self.width/2 - self.centers[1][span]
+        elif direction == 'bottom':
+            span = self._span(1, -self.width/2, -self.width/2 + size_slant)
+            distance = self.centers[1][span] + self.width/2
+        else:
+            raise ValueError("Invalid slant direction")
+        prism = distance[:, None] / size_slant + depth[None, :] / height_slant <= 1
+
+        if direction in ['left', 'right']:
+            self.voxels[span, :, span_z] &= ~prism[:, None, :]
+        else:
+            self.voxels[:, span, span_z] &= ~prism[None, :, :]
+
+    def compute_delta_volume(self):
+        if self.last_voxels is None or self.voxels is None:
+            raise ValueError("Voxel grids must be initialized.")
+        return np.logical_xor(self.last_voxels, self.voxels)
+
+    def rasterize_sequence(self, length, width, height, feature_list):
+        # Build the same frames as the FreeCAD pipeline: raw stock, one delta volume per feature and final part
+        self.create_raw_stock(length, width, height)
+        frames = np.empty((len(feature_list) + 2,) + tuple(self.voxel_resolution), dtype=bool)
+        operations = np.empty(len(feature_list) + 2, dtype=int)
+        frames[0] = self.voxels
+        operations[0] = RS_IDX
+        for i, feature in enumerate(feature_list):
+            self.create_feature(feature[0], *feature[1])
+            frames[i + 1] = self.compute_delta_volume()
+            operations[i + 1] = feature[0]
+        frames[-1] = self.voxels
+        operations[-1] = FP_IDX
+        return frames, operations
+
+    def compare_with_converter(self, length, width, height, feature_list, stl_files, method='scanline'):
+        # Parity mode: voxelize the STL files (or meshes) of the same sequence (raw stock first) with VoxelConverter
+        # and report the voxel disagreement against the analytic grids step by step
+        if len(stl_files) != len(feature_list) + 1:
+            raise ValueError("Expected one STL file for the raw stock and one per feature.")
+
+        converter = VoxelConverter(filename=None, stl_filename=None, voxel_resolution=self.voxel_resolution, method=method)
+        report = []
+        for step, stl_file in enumerate(stl_files):
+            if step == 0:
+                self.create_raw_stock(length, width, height)
+                operation = RS_IDX
+            else:
+                operation = feature_list[step - 1][0]
+                self.create_feature(operation, *feature_list[step - 1][1])
+            converter.convert_to_voxels(stl_file)
+
+            mismatch = np.count_nonzero(self.voxels != converter.voxels)
+            union = np.count_nonzero(self.voxels | converter.voxels)
+            report.append({
+                'step': step,
+                'operation': ALL_OPERATIONS[operation],
+                'analytic_voxels': int(np.count_nonzero(self.voxels)),
+                'converter_voxels': int(np.count_nonzero(converter.voxels)),
+                'mismatch': int(mismatch),
+                'iou': 1.0 - mismatch / union if union > 0 else 1.0,
+            })
+        return report
@@ -0,0 +1,52 @@
+import itertools
+import numpy as np
+
+def get_cube_rotations():
+    # The 24 rotations of the cube as (axis permutation, flipped axes) applied to the last three axes;
+    # code 0 is the identity
+    rotations = []
+    for perm in itertools.permutations(range(3)):
+        parity = np.linalg.det(np.eye(3)[list(perm)])
+        for flips in itertools.product([False, True], repeat=3):
+            if parity * (-1) ** sum(flips) > 0:
+                rotations.append((perm, tuple(k for k in range(3) if flips[k])))
+    return rotations
+
+CUBE_ROTATIONS = get_cube_rotations()
+
+def rotate_frames(frames, code):
+    # Rotate a frame (X, Y, Z) or a stack of frames (..., X, Y, Z) in one call; returns a view
+    perm, flips = CUBE_ROTATIONS[code]
+    lead = frames.ndim - 3
+    rotated = np.transpose(frames, tuple(range(lead)) + tuple(lead + k for k in perm))
+    if flips:
+        rotated = np.flip(rotated, axis=tuple(lead + k for k in flips))
+    return rotated
+
+def rotate_box(box, shape, code):
+    # Rotate a (origin..., extent...) box of a frame with the given shape
+    perm, flips = CUBE_ROTATIONS[code]
+    origin = np.array([box[k] for k in perm])
+    extent = np.array([box[3 + k] for k in perm])
+    rotated_shape = [shape[k] for k in perm]
+    for k in flips:
+        origin[k] = rotated_shape[k] - origin[k] - extent[k]
+    return np.concatenate([origin, extent])
+
+def get_rotation_code(rotation):
+    # Code of the cube rotation computed by a function on (X, Y, Z) arrays
+    test = np.arange(27).reshape(3, 3, 3)
+    for code in range(len(CUBE_ROTATIONS)):
+        if np.array_equal(rotate_frames(test, code), rotation(test)):
+            return code
+    raise ValueError("The function is not a rotation of the cube.")
+
+# The five rotations used by the original augmentation
+LEGACY_ROTATIONS = [
+    get_rotation_code(lambda x: np.rot90(x, 1, axes=(0, 1))),  # Rotate 90 degrees around axes (0, 1)
+    get_rotation_code(lambda x: np.rot90(x, 1, axes=(1, 2))),  # Rotate 90 degrees around axes (1, 2)
+    get_rotation_code(lambda x: np.rot90(x, 1, axes=(2, 0))),  # Rotate 90 degrees around axes (2, 0)
+    get_rotation_code(lambda x: np.rot90(x, 2, axes=(0, 1))),  # Rotate 180 degrees around axes (0, 1)
+    get_rotation_code(lambda x: np.rot90(x, 2, axes=(1, 2))),  # Rotate 180 degrees around axes (1, 2)
+]
+ALL_ROTATIONS = list(range(1, len(CUBE_ROTATIONS)))
@@ -0,0 +1,184 @@
+import os
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .storage import SequenceReader, pack_frames, unpack_frames
+
+INDEX_FILENAME = 'index.h5'
+
+def get_shard_filename(base_dir, shard):
+    return os.path.join(base_dir, f'shard_{str(shard).zfill(5)}.h5')
+
+def get_sample_id(h5_file_path, max_files_per_folder=3000):
+    # Sample id of a file in the seq_h5/NNNN/XXXXXXXX.h5 tree (folders hold max_files_per_folder files each)
+    folder = os.path.basename(os.path.dirname(h5_file_path))
+    return int(folder) * max_files_per_folder + int(os.path.basename(h5_file_path)[:-3])
+
+class ShardWriter:
+    def __init__(self, base_dir, samples_per_shard=1000, storage='packed', compression='gzip', compression_opts=None, first_shard=0):
+        # Append many variable-length sequences to a few large HDF5 files, keeping one handle open per shard
+        if storage not in ['dense', 'packed']:
+            raise ValueError(f"Invalid shard storage: {storage}")
+        os.makedirs(base_dir, exist_ok=True) # Several workers may create the shard directory at once
+        self.base_dir = base_dir
+        self.samples_per_shard = samples_per_shard
+        self.storage = storage
+        self.compression = compression if compression != 'none' else None
+        self.compression_opts = compression_opts
+        self.shard = first_shard - 1
+        self.h5file = None
+        self.num_samples = 0
+
+    def open_shard(self, frame_shape):
+        self.close_shard()
+        self.shard += 1
+        self.num_samples = 0
+        self.h5file = h5py.File(get_shard_filename(self.base_dir, self.shard), 'w')
+        stored_shape = frame_shape[:-1] + ((frame_shape[-1] + 7) // 8,) if self.storage == 'packed' else frame_shape
+        dtype = np.uint8 if self.storage == 'packed' else bool
+        voxels = self.h5file.create_dataset('voxels', shape=(0,) + stored_shape, maxshape=(None,) + stored_shape, dtype=dtype,
+                                            chunks=(1,) + stored_shape, compression=self.compression, compression_opts=self.compression_opts)
+        voxels.attrs['storage'] = self.storage
+        voxels.attrs['shape'] = frame_shape
+        self.h5file.create_dataset('operations', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+        for name in ['sample_ids', 'offsets', 'lengths']:
+            self.h5file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,))
+
+    def close_shard(self):
+        if self.h5file is not None:
+            self.h5file.close()
+            self.h5file = None
+
+    def add(self, sample_id, frames, operations):
+        # Append one sequence (T, X, Y, Z) with its T operations to the current shard
+        if self.h5file is None or self.num_samples >= self.samples_per_shard:
+            self.open_shard(frames.shape[1:])
+        data = pack_frames(frames) if self.storage == 'packed' else frames
+
+        # Resize once per sequence and write the whole block
+        voxels = self.h5file['voxels']
+        offset = voxels.shape[0]
+        voxels.resize(offset + len(frames), axis=0)
+        voxels[offset:] = data
+        self.h5file['operations'].resize(offset + len(frames), axis=0)
+        self.h5file['operations'][offset:] = operations
+        for name, value in [('sample_ids', sample_id), ('offsets', offset), ('lengths', len(frames))]:
+            self.h5file[name].resize(self.num_samples + 1, axis=0)
+            self.h5file[name][-1] = value
+        self.num_samples += 1
+
+    def close(self, index=True):
+        self.close_shard()
+        if index:
+            build_index(self.base_dir)
+
+def build_index(base_dir):
+    # Gather the per-shard indices into one table: sample id, shard, frame offset, length and operations
+    sample_ids, shards, offsets, lengths, operations = [], [], [], [], []
+    shard_files = sorted(f for f in os.listdir(base_dir) if f.startswith('shard_') and f.endswith('.h5'))
+    for shard_file in shard_files:
+        with h5py.File(os.path.join(base_dir, shard_file), 'r') as h5file:
+            shard_ids = h5file['sample_ids'][:]
+            sample_ids.append(shard_ids)
+            shards.append(np.full(len(shard_ids), int(shard_file[6:-3])))
+            offsets.append(h5file['offsets'][:])
+            lengths.append(h5file['lengths'][:])
+            operations.append(h5file['operations'][:])
+
+    sample_ids = np.concatenate(sample_ids) if sample_ids else np.zeros(0, dtype=np.int64)
+    if len(np.unique(sample_ids)) != len(sample_ids):
+        raise ValueError("Duplicate sample ids in the shards.")
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    with h5py.File(os.path.join(base_dir, INDEX_FILENAME), 'w') as h5file:
+        h5file.create_dataset('sample_ids', data=sample_ids)
+        h5file.create_dataset('shards', data=np.concatenate(shards) if shards else np.zeros(0, dtype=np.int64))
+        h5file.create_dataset('offsets', data=np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64))
+        h5file.create_dataset('lengths', data=lengths)
+        # Operations of sample k are operations[operation_offsets[k]:operation_offsets[k] + lengths[k]]
+        h5file.create_dataset('operations', data=np.concatenate(operations) if operations else np.zeros(0, dtype=np.int64))
+        h5file.create_dataset('operation_offsets', data=np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64) if len(lengths) else lengths)
+
+class ShardReader:
+    def __init__(self, base_dir):
+        # Random access to the sequences of a shard directory through its index
+        self.base_dir = base_dir
+        with h5py.File(os.path.join(base_dir, INDEX_FILENAME), 'r') as h5file:
+            self.sample_ids = h5file['sample_ids'][:]
+            self.shards = h5file['shards'][:]
+            self.offsets = h5file['offsets'][:]
+            self.lengths = h5file['lengths'][:]
+            self.operations = h5file['operations'][:]
+            self.operation_offsets = h5file['operation_offsets'][:]
+        self.positions = {int(sample_id): k for k, sample_id in enumerate(self.sample_ids)}
+        self.h5files = {}
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __contains__(self, sample_id):
+        return int(sample_id) in self.positions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_shard(self, shard):
+        # Shard files are opened once and kept open
+        if shard not in self.h5files:
+            self.h5files[shard] = h5py.File(get_shard_filename(self.base_dir, shard), 'r')
+        return self.h5files[shard]
+
+    def get_operations(self, sample_id):
+        k = self.positions[int(sample_id)]
+        return self.operations[self.operation_offsets[k]:self.operation_offsets[k] + self.lengths[k]]
+
+    def get(self, sample_id, out=None):
+        # Frames (T, X, Y, Z) and operations of a sample, optionally read into a preallocated array
+        k = self.positions[int(sample_id)]
+        voxels = self.get_shard(int(self.shards[k]))['voxels']
+        frames = voxels[self.offsets[k]:self.offsets[k] + self.lengths[k]]
+        if voxels.attrs['storage'] == 'packed':
+            frames = unpack_frames(frames, tuple(int(n) for n in voxels.attrs['shape']), out=out)
+        elif out is not None:
+            out[...] = frames
+            frames = out
+        return frames, self.get_operations(sample_id)
+
+    def close(self):
+        for h5file in self.h5files.values():
+            h5file.close()
+        self.h5files = {}
+
+def pack_shard(base_dir, shard, h5_files, storage='packed', compression='gzip', compression_opts=None, max_files_per_folder=3000):
+    # Write the given sample files into a single shard
+    writer = ShardWriter(base_dir, samples_per_shard=len(h5_files), storage=storage, compression=compression,
+                         compression_opts=compression_opts, first_shard=shard)
+    for h5_file in h5_files:
+        with SequenceReader(h5_file) as reader:
+            writer.add(get_sample_id(h5_file, max_files_per_folder), reader.read_batch(), reader.operations)
+    writer.close(index=False)
+    return shard
+
+def list_sample_files(base_h5_dir):
+    # Sample files of a seq_h5/NNNN/*.h5 tree in sample id order (staging entries and .tmp files are skipped)
+    h5_files = []
+    for folder in sorted(f for f in os.listdir(base_h5_dir) if f.isdigit()):
+        folder_path = os.path.join(base_h5_dir, folder)
+        h5_files.extend(os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.endswith('.h5') and f[:-3].isdigit())
+    return h5_files
+
+def pack_tree(base_h5_dir, base_dir, samples_per_shard=1000, num_workers=None, storage='packed', compression='gzip',
+              compression_opts=None, max_files_per_folder=3000):
+    # Pack an existing seq_h5/NNNN/*.h5 tree into shards, one shard per worker task, and build the index
+    h5_files = list_sample_files(base_h5_dir)
+
+    groups = [h5_files[i:i + samples_per_shard] for i in range(0, len(h5_files), samples_per_shard)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(pack_shard, base_dir, shard, group, storage, compression, compression_opts, max_files_per_folder)
+                   for shard, group in enumerate(groups)]
+        for future in futures:
+            future.result()
+    build_index(base_dir)
+    return len(h5_files)
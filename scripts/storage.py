@@ -0,0 +1,306 @@
+import h5py
+import numpy as np
+from .rotations import rotate_frames, rotate_box
+
+COMPRESSIONS = ['gzip', 'lzf', None]
+CHUNK_POLICIES = ['frame', 'sequence', 'auto']
+STORAGES = ['dense', 'packed', 'sparse'] # dense: one byte per voxel, packed: np.packbits along the last axis, sparse: packed bounding-box crops
+INITIAL_FRAMES = 16 # Initial capacity of the frame stack of a writer, doubled when a sequence is longer
+PYRAMID_MODES = ['any', 'fraction'] # any: a coarse voxel is set when any of its voxels is, fraction: occupied fraction of the block
+FRACTION_SCALE = 255 # Occupied fractions are stored as uint8 (0 to FRACTION_SCALE)
+
+def pack_frames(frames):
+    # Pack boolean frames (..., Z) into bytes (..., ceil(Z/8)) along the last axis
+    return np.packbits(frames, axis=-1)
+
+def unpack_frames(packed, shape, out=None):
+    # Unpack bytes (..., ceil(Z/8)) into boolean frames (..., Z), optionally into a preallocated array
+    unpacked = np.unpackbits(packed, axis=-1, count=shape[-1]).view(bool)
+    if out is None:
+        return unpacked
+    out[...] = unpacked
+    return out
+
+def downsample_frames(frames, factor, mode='any'):
+    # Block reduction of frames (..., X, Y, Z) by factor along the last three axes; the grid is padded with empty
+    # voxels to a multiple of factor. Returns booleans for 'any' and uint8 fractions (see FRACTION_SCALE) for 'fraction'
+    if mode not in PYRAMID_MODES:
+        raise ValueError(f"Invalid pyramid mode: {mode}")
+    lead = frames.shape[:-3]
+    padding = [(0, -n % factor) for n in frames.shape[-3:]]
+    if any(after for _, after in padding):
+        frames = np.pad(frames, [(0, 0)] * len(lead) + padding)
+    # Reduce one axis at a time over its factor strided slices (much faster than reducing a reshaped block view)
+    dtype = bool if mode == 'any' else (np.uint16 if factor ** 3 <= np.iinfo(np.uint16).max else np.uint32)
+    reduced = frames
+    for axis in range(-3, 0):
+        index = [slice(None)] * reduced.ndim
+        index[axis] = slice(0, None, factor)
+        accumulator = reduced[tuple(index)].astype(dtype)
+        for offset in range(1, factor):
+            index[axis] = slice(offset, None, factor)
+            if mode == 'any':
+                accumulator |= reduced[tuple(index)]
+            else:
+                accumulator += reduced[tuple(index)]
+        reduced = accumulator
+    if mode == 'any':
+        return reduced
+    return np.round(reduced * (FRACTION_SCALE / factor ** 3)).astype(np.uint8)
+
+def bounding_box(frame):
+    # Tight bounding box (origin, extent) of the nonzero voxels, with zero extent for an empty frame
+    origin = []
+    extent = []
+    for axis in range(frame.ndim):
+        other_axes = tuple(k for k in range(frame.ndim) if k != axis)
+        indices = np.flatnonzero(np.any(frame, axis=other_axes))
+        if len(indices) == 0:
+            return np.zeros(frame.ndim, dtype=int), np.zeros(frame.ndim, dtype=int)
+        origin.append(indices[0])
+        extent.append(indices[-1] - indices[0] + 1)
+    return np.array(origin), np.array(extent)
+
+def box_slices(box):
+    # Slices of a (origin..., extent...) box row
+    ndim = len(box) // 2
+    return tuple(slice(box[k], box[k] + box[ndim + k]) for k in range(ndim))
+
+class SequenceWriter:
+    def __init__(self, compression='gzip', compression_opts=None, chunks='frame', storage='dense', pyramid_levels=(), pyramid_mode='any'):
+        # Keep the frames of a sequence in memory and write them to the HDF5 file in a single call.
+        # pyramid_levels: downsampling factors (e.g. [2, 4] for 64^3 and 32^3) of the coarse copies stored next to the frames
+        if storage not in STORAGES:
+            raise ValueError(f"Invalid storage: {storage}")
+        if compression == 'none':
+            compression = None
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Invalid compression: {compression}")
+        if compression != 'gzip' and compression_opts is not None:
+            raise ValueError("Compression level is only supported by gzip.")
+        if chunks not in CHUNK_POLICIES and not isinstance(chunks, tuple):
+            raise ValueError(f"Invalid chunk policy: {chunks}")
+        if pyramid_mode not in PYRAMID_MODES:
+            raise ValueError(f"Invalid pyramid mode: {pyramid_mode}")
+        if any(factor < 2 for factor in pyramid_levels):
+            raise ValueError("Pyramid levels must be downsampling factors greater than 1.")
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunks = chunks
+        self.storage = storage
+        self.pyramid_levels = sorted(pyramid_levels)
+        self.pyramid_mode = pyramid_mode
+        self.frames = None # Preallocated (capacity, X, Y, Z) stack, reused by the following sequences
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def append(self, voxel_data, operation):
+        # Frames are copied into the stack since the caller may reuse its arrays for the next step
+        n = len(self.operations)
+        shape = np.shape(voxel_data)
+        if self.frames is None or (n == 0 and self.frames.shape[1:] != shape):
+            self.frames = np.empty((INITIAL_FRAMES,) + shape, dtype=bool)
+        elif self.frames.shape[1:] != shape:
+            raise ValueError("All the frames of a sequence must have the same shape.")
+        elif n == len(self.frames):
+            frames = np.empty((2 * n,) + shape, dtype=bool)
+            frames[:n] = self.frames
+            self.frames = frames
+        self.frames[n] = voxel_data
+        self.operations.append(operation)
+
+    def clear(self):
+        # The stack is kept for the next sequence
+        self.operations = []
+
+    def get_chunks(self, shape):
+        # Chunk shape of the voxels dataset for the given (T, X, Y, Z) shape
+        if self.chunks == 'frame':
+            return (1,) + shape[1:]
+        elif self.chunks == 'sequence':
+            return shape
+        elif self.chunks == 'auto':
+            return True
+        return self.chunks
+
+    def get_sequence(self):
+        # Buffered frames as one (T, X, Y, Z) array and the operations vector; the frames are a view of the stack,
+        # valid until the next append
+        return self.frames[:len(self)], np.array(self.operations)
+
+    def write(self, filename, frames=None, operations=None, orientations=None):
+        # Write the buffered sequence, or the given frames and operations; orientations are the cube rotation
+        # codes applied by the readers of the file (virtual augmentation)
+        if frames is None:
+            if not len(self):
+                raise ValueError("No frames to write.")
+            frames, operations = self.get_sequence()
+        shape = frames[0].shape
+        operations = np.array(operations)
+        if self.storage == 'sparse':
+            voxels, boxes, offsets = self.crop_frames(frames)
+        else:
+            voxels = np.stack(frames) if isinstance(frames, list) else frames
+            if self.storage == 'packed':
+                voxels = pack_frames(voxels)
+
+        # The datasets are created with their final size; maxshape keeps them resizable like the per-frame layout
+        with h5py.File(filename, 'w') as h5file:
+            if self.storage == 'sparse':
+                dataset = h5file.create_dataset('voxels', data=voxels, maxshape=(None,), chunks=True if len(voxels) > 0 else None,
+                                                compression=self.compression if len(voxels) > 0 else None,
+                                                compression_opts=self.compression_opts if len(voxels) > 0 else None)
+                h5file.create_dataset('boxes', data=boxes)
+                h5file.create_dataset('offsets', data=offsets)
+            else:
+                dataset = h5file.create_dataset('voxels', data=voxels, maxshape=(None,) + voxels.shape[1:], chunks=self.get_chunks(voxels.shape),
+                                                compression=self.compression, compression_opts=self.compression_opts)
+            dataset.attrs['storage'] = self.storage
+            dataset.attrs['shape'] = shape
+            h5file.create_dataset('operations', data=operations, maxshape=(None,), chunks=True,
+                                  compression=self.compression, compression_opts=self.compression_opts)
+            if orientations is not None:
+                h5file.attrs['orientations'] = orientations
+            if self.pyramid_levels:
+                self.write_pyramid(h5file, np.stack(frames) if isinstance(frames, list) else frames)
+        del voxels
+
+    def write_pyramid(self, h5file, frames):
+        # Coarse copies of the sequence in the 'pyramid' group, one dataset per downsampling factor. The 'any' levels
+        # are bit-packed unless the frames are stored dense; the 'fraction' levels are always dense uint8
+        group = h5file.create_group('pyramid')
+        group.attrs['mode'] = self.pyramid_mode
+        storage = 'packed' if self.pyramid_mode == 'any' and self.storage != 'dense' else 'dense'
+        for factor in self.pyramid_levels:
+            level = downsample_frames(frames, factor, self.pyramid_mode)
+            data = pack_frames(level) if storage == 'packed' else level
+            dataset = group.create_dataset(str(factor), data=data, maxshape=(None,) + data.shape[1:], chunks=self.get_chunks(data.shape),
+                                           compression=self.compression, compression_opts=self.compression_opts)
+            dataset.attrs['storage'] = storage
+            dataset.attrs['shape'] = level.shape[1:]
+
+    def crop_frames(self, frames):
+        # Crop every frame to the bounding box of its nonzero voxels and pack the crops into one byte stream
+        ndim = frames[0].ndim
+        boxes = np.zeros((len(frames), 2 * ndim), dtype=np.int32)
+        offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+        crops = []
+        for i, frame in enumerate(frames):
+            origin, extent = bounding_box(frame)
+            boxes[i] = np.concatenate([origin, extent])
+            crop = np.packbits(frame[box_slices(boxes[i])])
+            crops.append(crop)
+            offsets[i + 1] = offsets[i] + len(crop)
+        voxels = np.concatenate(crops) if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        return voxels, boxes, offsets
+
+class SequenceReader:
+    def __init__(self, filename, orientation=0, level=1):
+        # Read the frames of a sequence file on demand, unpacking them if they are stored bit-packed and
+        # rotating them by the given cube rotation code. level is the downsampling factor of a stored pyramid level;
+        # only that level is read ('fraction' levels are returned as float32 fractions)
+        self.filename = filename
+        self.orientation = orientation
+        self.level = level
+        self.h5file = h5py.File(filename, 'r')
+        self.operations = self.h5file['operations'][:]
+        self.orientations = [int(code) for code in self.h5file.attrs.get('orientations', [0])]
+        self.levels = [1] + sorted(int(factor) for factor in self.h5file['pyramid']) if 'pyramid' in self.h5file else [1]
+        self.scale = None
+        self.dtype = bool
+        if level == 1:
+            self.voxels = self.h5file['voxels']
+            self.storage = self.voxels.attrs.get('storage', 'dense') # Files written per frame have no attributes
+            self.stored_shape = tuple(int(n) for n in self.voxels.attrs.get('shape', self.voxels.shape[1:]))
+        else:
+            if level not in self.levels:
+                self.h5file.close()
+                raise ValueError(f"No pyramid level {level} in {filename}.")
+            self.voxels = self.h5file['pyramid'][str(level)]
+            self.storage = self.voxels.attrs.get('storage', 'dense')
+            self.stored_shape = tuple(int(n) for n in self.voxels.attrs.get('shape', self.voxels.shape[1:]))
+            if self.h5file['pyramid'].attrs['mode'] == 'fraction':
+                self.scale = FRACTION_SCALE
+                self.dtype = np.float32
+        self.shape = rotate_frames(np.empty(self.stored_shape, dtype=bool), orientation).shape
+        if self.storage == 'sparse':
+            self.boxes = self.h5file['boxes'][:]
+            self.offsets = self.h5file['offsets'][:]
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __getitem__(self, i):
+        return self.read_frame(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_crop(self, i):
+        # Bounding box (origin..., extent...) and boolean content of a frame, without building the dense grid
+        if self.storage != 'sparse':
+            frame = self.read_frame(i)
+            origin, extent = bounding_box(frame)
+            box = np.concatenate([origin, extent])
+            return box, frame[box_slices(box)]
+        box = self.boxes[i]
+        extent = tuple(box[len(box) // 2:])
+        packed = self.voxels[self.offsets[i]:self.offsets[i + 1]]
+        crop = np.unpackbits(packed, count=int(np.prod(extent))).view(bool).reshape(extent)
+        if self.orientation:
+            return rotate_box(box, self.stored_shape, self.orientation), rotate_frames(crop, self.orientation)
+        return box, crop
+
+    def read_frame(self, i, out=None):
+        if self.storage == 'sparse':
+            # Paste the (rotated) crop into a zeroed frame
+            box, crop = self.read_crop(i)
+            if out is None:
+                out = np.zeros(self.shape, dtype=self.dtype)
+            else:
+                out[...] = False
+            out[box_slices(box)] = crop
+            return out
+        if self.orientation:
+            # The rotation is a view of the stored frame
+            frame = rotate_frames(self.read_stored_frame(i), self.orientation)
+        else:
+            return self.read_stored_frame(i, out=out)
+        if out is None:
+            return frame
+        out[...] = frame
+        return out
+
+    def read_stored_frame(self, i, out=None):
+        # Dense or packed frame as stored, without rotation
+        frame = self.voxels[i]
+        if self.storage == 'packed':
+            return unpack_frames(frame, self.stored_shape, out=out)
+        if self.scale is not None:
+            frame = frame.astype(np.float32) / self.scale
+        if out is None:
+            return frame
+        out[...] = frame
+        return out
+
+    def read_batch(self, start=0, stop=None, out=None):
+        # Read frames [start, stop) into a preallocated (stop - start, X, Y, Z) array (boolean, or float32 for the
+        # 'fraction' pyramid levels)
+        stop = len(self) if stop is None else stop
+        if out is None:
+            out = np.empty((stop - start,) + self.shape, dtype=self.dtype)
+        if self.storage in ['packed', 'sparse'] or self.orientation or self.scale is not None:
+            # Unpack and rotate frame by frame so only one stored frame is held besides the output
+            for i in range(start, stop):
+                self.read_frame(i, out=out[i - start])
+        else:
+            self.voxels.read_direct(out, source_sel=np.s_[start:stop])
+        return out
+
+    def close(self):
+        self.h5file.close()
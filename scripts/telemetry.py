@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+class Telemetry:
+    def __init__(self, filename=None):
+        # Collect the stage wall times, loop counters and fields of the current sample and append them to filename
+        # as one JSONL record per sample. Outside of a sample every call is a no-op
+        self.filename = filename
+        self.record = None
+        self.start = None
+        self.lock = threading.Lock() # Stages also run in the background threads of the pipeline
+
+    @contextmanager
+    def sample(self, sample, **fields):
+        # Record of one sample over all its attempts; it is written even when the sample fails
+        self.start_sample(sample, **fields)
+        try:
+            yield self
+        except BaseException as e:
+            self.set(error=repr(e))
+            raise
+        finally:
+            self.end_sample()
+
+    def start_sample(self, sample, **fields):
+        self.record = {'sample': sample, 'start': time.time(), 'stages': {}, 'counts': {}, 'repeats': [], 'files': {}}
+        self.record.update(fields)
+        self.start = time.perf_counter()
+
+    def end_sample(self, **fields):
+        # Close the record of the current sample, append it to the file and return it
+        record, self.record = self.record, None
+        if record is None:
+            return None
+        record.update(fields)
+        record['time'] = time.perf_counter() - self.start
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    @contextmanager
+    def stage(self, name):
+        # Add the wall time of the block to a stage; the stages of the same name add up over the sample
+        if self.record is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            if self.record is not None:
+                self.record['stages'][name] = self.record['stages'].get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        # Iterations of a loop (placement attempts, voxelization passes...)
+        if self.record is not None:
+            with self.lock:
+                self.record['counts'][name] = self.record['counts'].get(name, 0) + n
+
+    def set(self, **fields):
+        if self.record is not None:
+            with self.lock:
+                self.record.update(fields)
+
+    def repeat(self, reason):
+        # Reason why the current attempt of the sample has to be repeated
+        if self.record is not None:
+            with self.lock:
+                self.record['repeats'].append(reason)
+
+    def add_files(self, filenames):
+        # Bytes written per file
+        if self.record is not None:
+            with self.lock:
+                for filename in filenames:
+                    if os.path.exists(filename):
+                        self.record['files'][filename] = os.path.getsize(filename)
+
+telemetry = Telemetry() # Inactive until a sample is started
+
+def get_telemetry():
+    return telemetry
+
+def set_telemetry(new_telemetry):
+    # Make new_telemetry the instance used by the instrumented classes; returns it
+    global telemetry
+    telemetry = new_telemetry
+    return telemetry
+
+def timed(stage):
+    # Decorator adding the wall time of every call to a stage of the current sample
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_telemetry().stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def read_records(filenames):
+    records = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError: # Last line of a worker killed while writing
+                    continue
+    return sorted(records, key=lambda record: record['start'])
+
+def get_percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {}
+    summary = {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+    summary.update(mean=float(values.mean()), max=float(values.max()))
+    return summary
+
+def is_failed(record):
+    # Exception in the sample, or an orchestrator sample that used up its attempts (the errors are caught as repeats)
+    return 'error' in record or record.get('status') == 'failed'
+
+def summarize(records, window=600):
+    # Percentiles of the sample and stage times, loop counters and bytes written, repeat reasons and the throughput
+    # over windows of the given number of seconds
+    if not records:
+        return {'samples': 0}
+    stages = sorted({name for record in records for name in record['stages']})
+    counts = sorted({name for record in records for name in record['counts']})
+    summary = {
+        'samples': len(records),
+        'failed': sum(1 for record in records if is_failed(record)),
+        'time': get_percentiles([record['time'] for record in records]),
+        'stages': {name: get_percentiles([record['stages'].get(name, 0.0) for record in records]) for name in stages},
+        'counts': {name: get_percentiles([record['counts'].get(name, 0) for record in records]) for name in counts},
+        'bytes': get_percentiles([sum(record['files'].values()) for record in records]),
+        'repeats': {},
+    }
+    for record in records:
+        for reason in record['repeats']:
+            summary['repeats'][reason] = summary['repeats'].get(reason, 0) + 1
+
+    # Samples per minute finished in every window since the first sample started
+    start = records[0]['start']
+    ends = np.array([record['start'] + record['time'] - start for record in records])
+    windows = np.bincount((ends // window).astype(int))
+    summary['throughput'] = [{'start': k * window, 'samples': int(n), 'samples_per_minute': 60 * int(n) / window}
+                             for k, n in enumerate(windows)]
+    return summary
+
+def print_summary(summary):
+    print(f"Samples: {summary['samples']}, failed: {summary.get('failed', 0)}")
+    if summary['samples'] == 0:
+        return
+    header = ' '.join(f'{name:>9}' for name in ['p50', 'p90', 'p99', 'max'])
+    print(f"{'':24} {header}")
+    rows = [('sample time (s)', summary['time'])] + [(f'{name} (s)', values) for name, values in summary['stages'].items()]
+    rows += [(name, values) for name, values in summary['counts'].items()] + [('bytes', summary['bytes'])]
+    for name, values in rows:
+        print(f"{name[:24]:24} " + ' '.join(f"{values[key]:9.3g}" for key in ['p50', 'p90', 'p99', 'max']))
+    for reason, n in sorted(summary['repeats'].items(), key=lambda item: -item[1]):
+        print(f"Repeated {n} times: {reason}")
+    print("Throughput (samples/min):")
+    for window in summary['throughput']:
+        print(f"  {window['start'] / 60:8.1f} min: {window['samples_per_minute']:.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the per-sample telemetry of a generation run.")
+    parser.add_argument('paths', nargs='+', help="Telemetry JSONL files or run directories (telemetry_*.jsonl)")
+    parser.add_argument('--window', type=float, default=600, help="Seconds per throughput window")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    filenames = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.startswith('telemetry_') and f.endswith('.jsonl'))
+        else:
+            filenames.append(path)
+    summary = summarize(read_records(filenames), args.window)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_summary(summary)
@@ -0,0 +1,110 @@
+import os
+import glob
+import shutil
+import tempfile
+import numpy as np
+from .macro import *
+from .utils import SampleAllocator, remove_stale_files, STALE_AGE
+
+MIN_FRAME_VOXELS = 200 # Frames with fewer voxels are considered empty
+
+def validate_sequence(frames, operations, voxel_resolution=None):
+    # Reason why a (T, X, Y, Z) sequence must be rejected, or None if it is valid
+    voxel_resolution = tuple(voxel_resolution) if voxel_resolution is not None else (VOL_DIM, VOL_DIM, VOL_DIM)
+    if frames.ndim != 4 or frames.shape[1:] != voxel_resolution:
+        return f"Invalid frame shape {frames.shape[1:]}."
+    if len(operations) != len(frames):
+        return "The number of operations does not match the number of frames."
+    if len(frames) < 3 or operations[0] != RS_IDX or operations[-1] != FP_IDX:
+        return "The sequence must start with the raw stock and end with the final part."
+    if any(operation not in [MILL_IDX, DRILL_IDX, SLANT_IDX] for operation in operations[1:-1]):
+        return "Invalid operation in the sequence."
+
+    counts = np.count_nonzero(frames.reshape(len(frames), -1), axis=1)
+    if np.any(counts <= MIN_FRAME_VOXELS):
+        return f"Voxel grid {int(np.argmin(counts))} is empty."
+    if counts[-1] >= counts[0]:
+        return "The final part has no less material than the raw stock."
+    return None
+
+class SampleTransaction:
+    def __init__(self, base_h5_dir='data/seq_h5', base_stl_dir='data/seq_stl', allocator=None, max_files_per_folder=3000,
+                 stale_age=STALE_AGE):
+        # Stage the STL files and voxel sequences of a sample and move them into the tree only when it is committed.
+        # Each tree gets its own staging directory so the final renames stay on the same filesystem. The staging
+        # directories of crashed processes (older than stale_age) are removed first
+        os.makedirs(base_h5_dir, exist_ok=True)
+        os.makedirs(base_stl_dir, exist_ok=True)
+        remove_stale_files(glob.glob(os.path.join(base_h5_dir, '.stage_*')) + glob.glob(os.path.join(base_stl_dir, '.stage_*')), stale_age)
+        self.base_h5_dir = base_h5_dir
+        self.base_stl_dir = base_stl_dir
+        self.allocator = allocator if allocator is not None else SampleAllocator(base_h5_dir, base_stl_dir, max_files_per_folder)
+        self.stage_dir = tempfile.mkdtemp(prefix='.stage_', dir=base_stl_dir)
+        self.h5_stage_dir = tempfile.mkdtemp(prefix='.stage_', dir=base_h5_dir)
+        self.stl_filename = os.path.join(self.stage_dir, 'sample_00.stl') # Following STL files are named with get_next_stl_filename
+        self.sequences = []
+        self.h5_files = []
+        self.stl_files = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.abort()
+
+    def add_sequence(self, frames, operations, orientations=None):
+        # Nothing is written until commit; frames may be views of the same array
+        self.sequences.append((frames, operations, orientations))
+
+    def validate(self, voxel_resolution=None):
+        # Reason why the added sequences must be rejected, or None if the sample can be committed
+        if not self.sequences:
+            return "No sequence to commit."
+        for frames, operations, _ in self.sequences:
+            reason = validate_sequence(frames, operations, voxel_resolution)
+            if reason is not None:
+                return reason
+        return None
+
+    def commit(self, writer):
+        if self.closed:
+            raise ValueError("The transaction is already closed.")
+
+        # Write every sequence to the staging directory first; a write error aborts before any id is taken
+        staged_files = []
+        try:
+            for k, (frames, operations, orientations) in enumerate(self.sequences):
+                staged_files.append(os.path.join(self.h5_stage_dir, f'sequence_{str(k).zfill(2)}.h5'))
+                writer.write(staged_files[-1], frames, operations, orientations=orientations)
+        except Exception:
+            self.abort()
+            raise
+
+        # Sample ids are taken only now, so rejected and failed samples leave no gaps in the numbering.
+        # The files are moved into the tree with atomic renames
+        for k, staged_file in enumerate(staged_files):
+            h5_file_path, stl_file_path = self.allocator.next_filenames()
+            os.replace(staged_file, h5_file_path)
+            self.h5_files.append(h5_file_path)
+
+            # The STL files belong to the first sequence (the augmented copies share the geometry)
+            if k == 0:
+                for staged_stl_file in sorted(glob.glob(os.path.join(self.stage_dir, 'sample_??.stl'))):
+                    final_file = stl_file_path[:-6] + staged_stl_file[-6:]
+                    os.replace(staged_stl_file, final_file)
+                    self.stl_files.append(final_file)
+        self.sequences = []
+        self.closed = True
+        self.remove_stage()
+
+    def abort(self):
+        # Drop the staged files; a no-op once the transaction is committed
+        if not self.closed:
+            self.sequences = []
+            self.closed = True
+            self.remove_stage()
+
+    def remove_stage(self):
+        shutil.rmtree(self.stage_dir, ignore_errors=True)
+        shutil.rmtree(self.h5_stage_dir, ignore_errors=True)
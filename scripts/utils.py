@@ -1,7 +1,37 @@
 import os
+import glob
+import time
+import shutil
 import numpy as np
+from collections import deque
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+from concurrent.futures import ThreadPoolExecutor
 from .macro import *
 
+STALE_AGE = 3600 # Seconds without modification after which the staging files of a crashed process are removed
+
+def remove_stale_files(paths, max_age=STALE_AGE):
+    # Remove the files and directories among paths that were not modified within max_age seconds (the live staging
+    # entries of other processes are recent); returns the removed paths
+    removed = []
+    now = time.time()
+    for path in paths:
+        try:
+            if now - os.path.getmtime(path) < max_age:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed.append(path)
+        except OSError: # Removed by another process in the meantime
+            continue
+    return removed
+
 def get_next_filenames(base_h5_dir='data/seq_h5', base_stl_dir='data/seq_stl', max_files_per_folder=3000):
  # Ensure base directories exist
     if not os.path.exists(base_h5_dir):
@@ -51,6 +81,187 @@ def get_next_filenames(base_h5_dir='data/seq_h5', base_stl_dir='data/seq_stl', m
 
     return next_h5_file_path, next_stl_file_path
 
+def scan_next_sample_id(base_h5_dir='data/seq_h5', max_files_per_folder=3000):
+    # Next sample id after the highest numbered file in the H5 tree (sample id = folder * max_files_per_folder + file)
+    if not os.path.exists(base_h5_dir):
+        return 0
+    h5_folders = [f for f in os.listdir(base_h5_dir) if f.isdigit()]
+    if not h5_folders:
+        return 0
+    latest_h5_folder = max(h5_folders)
+    h5_files = [f for f in os.listdir(os.path.join(base_h5_dir, latest_h5_folder)) if f.endswith('.h5') and f[:-3].isdigit()]
+    if not h5_files:
+        return int(latest_h5_folder) * max_files_per_folder
+    return int(latest_h5_folder) * max_files_per_folder + int(max(h5_files)[:-3]) + 1
+
+class SampleAllocator:
+    def __init__(self, base_h5_dir='data/seq_h5', base_stl_dir='data/seq_stl', max_files_per_folder=3000, block_size=1, lock_timeout=60,
+                 stale_age=STALE_AGE):
+        # Hand out H5/STL path pairs from a persistent counter shared by all the processes writing to the same tree.
+        # The counter is guarded by an OS lock on a persistent lock file, released by the OS if its owner crashes;
+        # lock_timeout is the time to wait for it before giving up. The *.tmp files left in the tree by crashed
+        # writers are removed once they are older than stale_age
+        os.makedirs(base_h5_dir, exist_ok=True)
+        os.makedirs(base_stl_dir, exist_ok=True)
+        remove_stale_files(glob.glob(os.path.join(base_h5_dir, '*', '*.tmp')), stale_age)
+        self.base_h5_dir = base_h5_dir
+        self.base_stl_dir = base_stl_dir
+        self.max_files_per_folder = max_files_per_folder
+        self.block_size = block_size
+        self.lock_timeout = lock_timeout
+        self.counter_path = os.path.join(base_h5_dir, 'next_sample_id')
+        self.lock_path = self.counter_path + '.lock'
+        self.next_id = 0
+        self.end_id = 0
+        self.lock_file = None
+
+    def acquire_lock(self):
+        # The lock file is never removed, so every process locks the same inode
+        lock_file = open(self.lock_path, 'a+')
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                self.lock_file = lock_file
+                return
+            except OSError:
+                if time.time() > deadline:
+                    lock_file.close()
+                    raise TimeoutError(f"Could not lock {self.lock_path} within {self.lock_timeout} s.")
+                time.sleep(0.01)
+
+    def release_lock(self):
+        # Only the owner of the lock can release it
+        lock_file, self.lock_file = self.lock_file, None
+        if lock_file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            lock_file.close()
+
+    def reserve(self, count):
+        # Atomically reserve the ids [start, start + count)
+        self.acquire_lock()
+        try:
+            if os.path.exists(self.counter_path):
+                with open(self.counter_path) as f:
+                    start = int(f.read())
+            else:
+                # The tree is scanned only once, when the counter is created
+                start = scan_next_sample_id(self.base_h5_dir, self.max_files_per_folder)
+            temp_path = f'{self.counter_path}.{os.getpid()}'
+            with open(temp_path, 'w') as f:
+                f.write(str(start + count))
+            os.replace(temp_path, self.counter_path)
+        finally:
+            self.release_lock()
+        return start, start + count
+
+    def next_sample_id(self):
+        if self.next_id >= self.end_id:
+            self.next_id, self.end_id = self.reserve(self.block_size)
+        sample_id = self.next_id
+        self.next_id += 1
+        return sample_id
+
+    def get_filenames(self, sample_id):
+        # Same layout as get_next_filenames: NNNN/XXXXXXXX.h5 and NNNN/XXXXXXXX_00.stl
+        folder = str(sample_id // self.max_files_per_folder).zfill(4)
+        filename = str(sample_id % self.max_files_per_folder).zfill(8)
+        h5_folder_path = os.path.join(self.base_h5_dir, folder)
+        stl_folder_path = os.path.join(self.base_stl_dir, folder)
+        os.makedirs(h5_folder_path, exist_ok=True)
+        os.makedirs(stl_folder_path, exist_ok=True)
+        return os.path.join(h5_folder_path, filename + '.h5'), os.path.join(stl_folder_path, filename + '_00.stl')
+
+    def next_filenames(self):
+        return self.get_filenames(self.next_sample_id())
+
+class MeshArchiver:
+    def __init__(self, enabled=True, num_threads=1):
+        # Export meshes to STL files in background threads; the files are kept for archival only, since the
+        # voxelizer receives the meshes in memory
+        self.enabled = enabled
+        self.executor = ThreadPoolExecutor(max_workers=num_threads) if enabled else None
+        self.futures = []
+
+    def submit(self, mesh, stl_file_path):
+        # The export thread gets its own copy: the caller passes the same mesh to the voxel stage, and the two
+        # threads must not share the trimesh cache
+        if self.enabled:
+            self.futures.append(self.executor.submit(mesh.copy().export, stl_file_path))
+
+    def wait(self):
+        # Block until every submitted file is written (raises the first export error)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self.executor is not None:
+            try:
+                self.wait()
+            finally:
+                self.executor.shutdown()
+                self.executor = None
+
+    def cancel(self):
+        # Drop the queued exports and wait for the running one; the staged files are discarded with the sample
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+class PipelineStage:
+    def __init__(self, enabled=True, max_pending=4):
+        # Run the calls of a pipeline stage in order in one background thread, so they overlap with the work of the
+        # caller (the CAD steps); submit blocks while max_pending calls are queued, which keeps the meshes held in
+        # memory bounded. When disabled the calls run inline
+        self.enabled = enabled
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1) if enabled else None
+        self.futures = deque()
+
+    def submit(self, func, *args, **kwargs):
+        if not self.enabled:
+            func(*args, **kwargs)
+            return
+        while len(self.futures) >= self.max_pending:
+            self.futures.popleft().result() # Raises the error of a failed call in the caller
+        self.futures.append(self.executor.submit(func, *args, **kwargs))
+
+    def wait(self):
+        # Block until every submitted call is done (raises the first error)
+        while self.futures:
+            self.futures.popleft().result()
+
+    def close(self):
+        if self.executor is not None:
+            try:
+                self.wait()
+            finally:
+                self.cancel()
+
+    def cancel(self):
+        # Drop the queued calls and wait for the running one, so the stage no longer touches the shared state
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
 def get_next_stl_filename(stl_file_path):
     base, ext = os.path.splitext(stl_file_path)
     if not base[-2:].isdigit():
@@ -61,7 +272,8 @@ def get_next_stl_filename(stl_file_path):
     next_stl_file_path = f"{base[:-2]}{next_number}{ext}"
     return next_stl_file_path
 
-def select_feature_combinations():
+def select_feature_combinations(rng=None):
+    # rng is a random.Random instance (or the random module); np.random is used when it is not given
     # Define the feature combinations and their corresponding cases
     combinations = [
         (10, [MILL_IDX, SLANT_IDX, DRILL_IDX], "No Intersection"),
@@ -81,7 +293,10 @@ def select_feature_combinations():
         (10, [SLANT_IDX, DRILL_IDX, MILL_IDX], "Intersection Mill-Drill Mill-Slant"),
     ]
     weights = [c[0] for c in combinations]
-    idx = np.random.choice(len(combinations), p=weights/np.sum(weights))
+    if rng is None:
+        idx = np.random.choice(len(combinations), p=weights/np.sum(weights))
+    else:
+        idx = rng.choices(range(len(combinations)), weights=weights)[0]
     combination = combinations[idx][1]
     case = combinations[idx][2]
     return combination, case
@@ -91,9 +306,159 @@ class SurfaceMap:
         self.length = length
         self.width = width
         self.grid = np.zeros((length, width), dtype=dtype)
-    
+        self.sums = np.zeros((length + 1, width + 1), dtype=np.int64)
+        # The table is brought up to date by the first query after a write (the depth map is written often but only
+        # read through region_max): pending rectangle changes, and the first corner of a quadrant to rebuild
+        self.pending = []
+        self.rebuild_from = None
+        self.padded = {} # Edge-padded tables of free_windows per margin, until the next write
+
+    @property
+    def table(self):
+        # Summed-area table: table[i, j] is the sum of grid[:i, :j]
+        self.flush()
+        return self.sums
+
+    def __getitem__(self, key):
+        return self.grid[key]
+
+    def __setitem__(self, key, value):
+        # Mark a region (same indexing as the grid); the summed-area table is updated at the next query
+        key = key if isinstance(key, tuple) else (key,)
+        self.padded = {}
+        region = self.get_region(key)
+        if region is not None:
+            start_i, end_i, start_j, end_j = region
+            old = self.grid[start_i:end_i, start_j:end_j].astype(np.int64)
+            self.grid[key] = value
+            if end_i > start_i and end_j > start_j:
+                self.pending.append((start_i, start_j, self.grid[start_i:end_i, start_j:end_j].astype(np.int64) - old))
+            return
+        self.grid[key] = value
+        start_i = self.get_first_index(key[0], self.length)
+        start_j = self.get_first_index(key[1], self.width) if len(key) > 1 else 0
+        if start_i is not None and start_j is not None:
+            corner = self.rebuild_from if self.rebuild_from is not None else (start_i, start_j)
+            self.rebuild_from = (min(corner[0], start_i), min(corner[1], start_j))
+
+    def flush(self):
+        # Apply the pending writes to the table; a rebuild of the quadrant also covers the changes inside it
+        if self.rebuild_from is not None:
+            start_i = min([self.rebuild_from[0]] + [i for i, _, _ in self.pending])
+            start_j = min([self.rebuild_from[1]] + [j for _, j, _ in self.pending])
+            self.update_table(start_i, start_j)
+        else:
+            for start_i, start_j, delta in self.pending:
+                self.add_to_table(start_i, start_j, delta)
+        self.pending = []
+        self.rebuild_from = None
+
+    def get_first_index(self, key, n):
+        # First row/column touched by an index, or None if the index selects nothing
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if len(range(start, stop, step)) == 0:
+                return None
+            return min(start, start + (len(range(start, stop, step)) - 1) * step)
+        if isinstance(key, (int, np.integer)):
+            return key % n
+        return 0 # Array indices: update the whole table
+
+    def get_region(self, key):
+        # (start_i, end_i, start_j, end_j) of a rectangular index (integers and step 1 slices), None for other indices
+        region = []
+        for k, n in zip(key + (slice(None),) * (2 - len(key)), (self.length, self.width)):
+            if isinstance(k, slice) and k.step in (None, 1):
+                start, end = self.get_bounds(k.start, k.stop, n)
+            elif isinstance(k, (int, np.integer)) and -n <= k < n:
+                start, end = k % n, k % n + 1
+            else:
+                return None
+            region += [start, end]
+        return tuple(region) if len(key) <= 2 else None
+
+    def add_to_table(self, start_i, start_j, delta):
+        # Rank update of the table for a change delta of the rectangle at (start_i, start_j): table[i, j] grows by
+        # the sum of delta over the part of the rectangle above and left of (i, j). Inside the rectangle that is the
+        # summed-area table of delta, below and right of it its last row, column and total. The cumulative sums only
+        # cover the rectangle; the rest of the quadrant gets broadcast additions
+        h, w = delta.shape
+        end_i, end_j = start_i + h, start_j + w
+        block = np.cumsum(np.cumsum(delta, axis=0), axis=1)
+        self.sums[start_i+1:end_i+1, start_j+1:end_j+1] += block
+        self.sums[end_i+1:, start_j+1:end_j+1] += block[-1][None, :]
+        self.sums[start_i+1:end_i+1, end_j+1:] += block[:, -1][:, None]
+        self.sums[end_i+1:, end_j+1:] += block[-1, -1]
+
+    def update_table(self, start_i, start_j):
+        # Rebuild for the indices that are not a rectangle (arrays, masks, steps), O(size of the quadrant)
+        # Only the entries below and right of (start_i, start_j) depend on the updated cells
+        block = np.cumsum(np.cumsum(self.grid[start_i:, start_j:], axis=0, dtype=np.int64), axis=1)
+        self.sums[start_i+1:, start_j+1:] = block + self.sums[start_i, start_j+1:][None, :] + self.sums[start_i+1:, start_j][:, None] - self.sums[start_i, start_j]
+
+    def get_bounds(self, start, end, n):
+        # Same bounds as the slice start:end of an axis of length n
+        start, end, _ = slice(start, end).indices(n)
+        return start, max(start, end)
+
+    def region_sum(self, start_i, end_i, start_j, end_j):
+        # Constant time, from the summed-area table
+        start_i, end_i = self.get_bounds(start_i, end_i, self.length)
+        start_j, end_j = self.get_bounds(start_j, end_j, self.width)
+        table = self.table
+        return table[end_i, end_j] - table[start_i, end_j] - table[end_i, start_j] + table[start_i, start_j]
+
+    def region_max(self, start_i, end_i, start_j, end_j):
+        # Not constant time: a max over the slice, O(area). On maps up to 128 x 128 it takes 6-10 us, less than
+        # keeping a max structure (a 2D sparse table) current through every depth update would cost
+        return np.max(self.grid[start_i:end_i, start_j:end_j])
+
     def is_free(self, start_i, end_i, start_j, end_j):
-        return not np.any(self.grid[start_i:end_i, start_j:end_j])
-    
+        # Constant time; the grids hold flags or non-negative depths
+        return self.region_sum(start_i, end_i, start_j, end_j) == 0
+
     def is_not_free(self, start_i, end_i, start_j, end_j):
-        return np.any(self.grid[start_i:end_i, start_j:end_j])
\ No newline at end of file
+        return not self.is_free(start_i, end_i, start_j, end_j)
+
+    def free_windows(self, h, w, margin=0):
+        # Mask over the top-left corners (i, j) of the h x w windows that are free, including a margin around them
+        # (clipped at the borders of the grid). Replicating the edges of the table does the clipping, so the corners
+        # of the windows are plain slices of the padded table
+        n_i, n_j = max(self.length - h + 1, 0), max(self.width - w + 1, 0)
+        table = self.table
+        if margin > 0:
+            if margin not in self.padded:
+                self.padded[margin] = np.pad(table, margin, mode='edge')
+            table = self.padded[margin]
+        end_i, end_j = h + 2 * margin, w + 2 * margin
+        # Sums of the row bands of the windows; a window is free when its band sum does not grow over its columns
+        rows = table[end_i:end_i + n_i] - table[:n_i]
+        return rows[:, end_j:end_j + n_j] == rows[:, :n_j]
+
+    def sample_window(self, h, w, rng, margin=0, rows=None, cols=None, mask=None):
+        # Top-left corner (i, j) drawn uniformly from the free h x w windows (see free_windows), or None if there is none.
+        # rows and cols restrict the corners to the given start indices and mask to the True entries of a mask over the corners
+        candidates = self.free_windows(h, w, margin)
+        if rows is not None:
+            allowed = np.zeros(candidates.shape[0], dtype=bool)
+            allowed[[i for i in rows if 0 <= i < candidates.shape[0]]] = True
+            candidates &= allowed[:, None]
+        if cols is not None:
+            allowed = np.zeros(candidates.shape[1], dtype=bool)
+            allowed[[j for j in cols if 0 <= j < candidates.shape[1]]] = True
+            candidates &= allowed[None, :]
+        if mask is not None:
+            candidates &= mask
+        corners = np.flatnonzero(candidates)
+        if len(corners) == 0:
+            return None
+        i, j = np.unravel_index(corners[rng.randrange(len(corners))], candidates.shape)
+        return int(i), int(j)
+
+def window_any(mask, h, w):
+    # For every top-left corner (i, j), whether mask[i:i+h, j:j+w] has a True entry
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0, dtype=np.int64), axis=1)
+    n, m = max(mask.shape[0] - h + 1, 0), max(mask.shape[1] - w + 1, 0)
+    counts = table[h:h + n, w:w + m] - table[:n, w:w + m] - table[h:h + n, :m] + table[:n, :m]
+    return counts > 0
@@ -1,64 +1,219 @@
 import trimesh
 import numpy as np
-import h5py
 import gc
 import os
 import glob
 from scipy.ndimage import binary_fill_holes
 from .macro import *
 from .utils import get_next_filenames
+from .storage import SequenceWriter
+from .rotations import LEGACY_ROTATIONS, rotate_frames
+from .transaction import validate_sequence
+from .telemetry import get_telemetry, timed
+
+VOXELIZATION_METHODS = ['scanline', 'binvox']
+RAY_OFFSET = (np.sqrt(2) * 1e-6, np.sqrt(3) * 1e-6) # Keeps the rays off the edges and vertices shared by two triangles
+
+def get_padding(shape, resolution):
+    # Padding (before, after) per axis that centers a grid of the given shape in the voxel resolution
+    return [((resolution[k] - shape[k]) // 2, (resolution[k] - shape[k]) // 2 + (resolution[k] - shape[k]) % 2) for k in range(3)]
+
+def pad_to_resolution(voxel_grid, resolution, out=None):
+    # Center the grid in the voxel resolution, writing it into a preallocated array when out is given
+    if out is None:
+        return np.pad(voxel_grid, get_padding(voxel_grid.shape, resolution), mode='constant', constant_values=False)
+    padding = get_padding(voxel_grid.shape, resolution)
+    out[...] = False
+    out[tuple(slice(before, before + n) for (before, _), n in zip(padding, voxel_grid.shape))] = voxel_grid
+    return out
+
+def voxelize_mesh(mesh, shape=None, columns=None):
+    # Solid voxelization of a watertight mesh on the unit grid anchored at its minimum corner (the grid binvox produces,
+    # cropped to int(extent) voxels per axis): a voxel is filled when its centre is inside the mesh, which is the parity
+    # of the crossings of the ray along z through the centre of its column.
+    # columns (i0, i1, j0, j1) restricts the result to the columns [i0, i1) x [j0, j1)
+    shape = tuple(int(n) for n in (shape if shape is not None else mesh.extents))
+    i0, i1, j0, j1 = columns if columns is not None else (0, shape[0], 0, shape[1])
+    triangles = mesh.triangles - mesh.bounds[0]
+    # Column coordinates: the ray of column (i, j) is at u = i, v = j
+    u = triangles[:, :, 0] - 0.5 - RAY_OFFSET[0]
+    v = triangles[:, :, 1] - 0.5 - RAY_OFFSET[1]
+    z = triangles[:, :, 2]
+
+    # Triangles seen edge-on from above (walls) are never crossed by a ray
+    det = (v[:, 1] - v[:, 2]) * (u[:, 0] - u[:, 2]) + (u[:, 2] - u[:, 1]) * (v[:, 0] - v[:, 2])
+    keep = np.abs(det) > 1e-12
+    u, v, z, det = u[keep], v[keep], z[keep], det[keep]
+
+    # Columns inside the bounding box of every triangle, enumerated for all the triangles at once
+    i_start = np.clip(np.ceil(u.min(axis=1)), i0, i1).astype(np.int64)
+    i_end = np.clip(np.floor(u.max(axis=1)) + 1, i0, i1).astype(np.int64)
+    j_start = np.clip(np.ceil(v.min(axis=1)), j0, j1).astype(np.int64)
+    j_end = np.clip(np.floor(v.max(axis=1)) + 1, j0, j1).astype(np.int64)
+    n_i = np.maximum(i_end - i_start, 0)
+    n_j = np.maximum(j_end - j_start, 0)
+    counts = n_i * n_j
+    triangle = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = i_start[triangle] + local // n_j[triangle]
+    j = j_start[triangle] + local % n_j[triangle]
+
+    # Barycentric coordinates of the rays in the projected triangles and height of the crossings
+    du = i - u[triangle, 2]
+    dv = j - v[triangle, 2]
+    l1 = ((v[triangle, 1] - v[triangle, 2]) * du + (u[triangle, 2] - u[triangle, 1]) * dv) / det[triangle]
+    l2 = ((v[triangle, 2] - v[triangle, 0]) * du + (u[triangle, 0] - u[triangle, 2]) * dv) / det[triangle]
+    l3 = 1 - l1 - l2
+    inside = (l1 >= 0) & (l2 >= 0) & (l3 >= 0)
+    triangle, i, j = triangle[inside], i[inside], j[inside]
+    height = l1[inside] * z[triangle, 0] + l2[inside] * z[triangle, 1] + l3[inside] * z[triangle, 2]
+
+    # Every crossing toggles the voxels whose centre (k + 0.5) is above it; the parity is a running sum along z
+    k = np.clip(np.floor(height + 0.5), 0, shape[2]).astype(np.int64)
+    n_i, n_j = i1 - i0, j1 - j0
+    toggles = np.bincount(((i - i0) * n_j + (j - j0)) * (shape[2] + 1) + k, minlength=n_i * n_j * (shape[2] + 1))
+    toggles = toggles.reshape(n_i, n_j, shape[2] + 1)[:, :, :shape[2]].astype(np.uint8)
+    return (np.cumsum(toggles, axis=2, dtype=np.uint8) & 1).astype(bool)
+
+def feature_bounds(feature_type, args, length, width, height):
+    # Bounds [[x, y, z] min, [x, y, z] max] of the material a feature can remove, in the frame of the raw stock
+    # (centered at the origin, top face at z = height/2)
+    top = height / 2
+    if feature_type == MILL_IDX:
+        length_mill, width_mill, depth, x, y = args
+        return np.array([[x - length_mill/2, y - width_mill/2, top - depth], [x + length_mill/2, y + width_mill/2, top]])
+    elif feature_type == DRILL_IDX:
+        diameter, depth, x, y = args
+        return np.array([[x - diameter/2, y - diameter/2, top - depth], [x + diameter/2, y + diameter/2, top]])
+    elif feature_type == SLANT_IDX:
+        direction, size_slant, height_slant = args
+        bounds = np.array([[-length/2, -width/2, top - height_slant], [length/2, width/2, top]])
+        if direction == 'left':
+            bounds[1, 0] = -length/2 + size_slant
+        elif direction == 'right':
+            bounds[0, 0] = length/2 - size_slant
+        elif direction == 'top':
+            bounds[0, 1] = width/2 - size_slant
+        elif direction == 'bottom':
+            bounds[1, 1] = -width/2 + size_slant
+        return bounds
+    raise ValueError("Invalid feature type")
 
 class VoxelConverter:
-    def __init__(self, filename, stl_filename, voxel_resolution=None):
-        # Initialize with STL file and voxel grid parameters
+    def __init__(self, filename, stl_filename, voxel_resolution=None, compression='gzip', compression_opts=None, chunks='frame', storage='dense',
+                 method='scanline', collect_garbage=False, pyramid_levels=(), pyramid_mode='any'):
+        # Initialize with STL file and voxel grid parameters; method is 'scanline' (in-process) or 'binvox' (external executable).
+        # collect_garbage runs a full gc.collect() after every step, as the converter originally did.
+        # pyramid_levels and pyramid_mode add downsampled copies of the sequences to the files (see SequenceWriter)
+        if method not in VOXELIZATION_METHODS:
+            raise ValueError(f"Invalid voxelization method: {method}")
+        self.voxel_resolution = voxel_resolution if voxel_resolution is not None else np.array([128, 128, 128])
+        self.method = method
+        self.collect_garbage = collect_garbage
+        # Two frame buffers swap roles at every step (current and last grid) and the delta is computed into a third one
+        self.buffers = [np.zeros(tuple(self.voxel_resolution), dtype=bool) for _ in range(2)]
+        self.delta_voxels = np.zeros(tuple(self.voxel_resolution), dtype=bool)
+        # Frames are buffered in memory and written to the HDF5 file once per sequence
+        self.writer = SequenceWriter(compression=compression, compression_opts=compression_opts, chunks=chunks, storage=storage,
+                                     pyramid_levels=pyramid_levels, pyramid_mode=pyramid_mode)
+        self.reset(filename, stl_filename)
+
+    def reset(self, filename, stl_filename):
+        # Start a new sample, keeping the buffers and the writer of the previous one
         self.filename = filename
         self.stl_filename = stl_filename
-        self.voxel_resolution = voxel_resolution if voxel_resolution is not None else np.array([128, 128, 128])
+        self.grid_bounds = None # Mesh bounds, shape and padding of the last full voxelization
+        self.grid_shape = None
+        self.padding = None
+        self.region = None # Slices of the grid updated by the last incremental voxelization
+        self.mesh_volume = None
         self.voxels = None
         self.last_voxels = None
+        self.writer.clear()
+        self.written_files = []
+        return self
+
+    def release_memory(self):
+        # Full collections stall every step, so they only run when they were requested
+        if self.collect_garbage:
+            gc.collect()
 
     def append_to_h5file(self, voxel_data, operation):
-        with h5py.File(self.filename, 'a') as h5file:  # Open file in append mode
-            if 'voxels' not in h5file:
-                maxshape = (None,) + voxel_data.shape
-                chunks = (1,) + voxel_data.shape  # Adjust chunk size as necessary
-                h5file.create_dataset('voxels', data=[voxel_data], maxshape=maxshape, chunks=chunks, compression='gzip')
-                h5file.create_dataset('operations', data=[operation], maxshape=(None,), chunks=(1,), compression='gzip')
-            else:
-                h5file['voxels'].resize((h5file['voxels'].shape[0] + 1), axis=0)
-                h5file['voxels'][-1] = voxel_data
-                h5file['operations'].resize((h5file['operations'].shape[0] + 1), axis=0)
-                h5file['operations'][-1] = operation
+        self.writer.append(voxel_data, operation)
+
+    def flush(self):
+        # Write the buffered sequence to the current HDF5 file
+        self.writer.write(self.filename)
+        self.writer.clear()
+        self.written_files.append(self.filename)
 
-    def convert_to_voxels(self, stl_file, operation=None):
-        self.last_voxels = self.voxels.copy() if self.voxels is not None else None
+    @timed('voxelize')
+    def convert_to_voxels(self, stl_file, operation=None, bounds=None):
+        # bounds: region the last feature can have changed (feature_bounds); only the voxel columns below it are
+        # voxelized again, with a full pass when the incremental update cannot be trusted
+        # The current grid becomes the last one and the new grid is written into the other buffer
+        self.last_voxels = self.voxels
+        self.voxels = self.buffers[1] if self.voxels is self.buffers[0] else self.buffers[0]
 
-        # Load the mesh from the STL file
-        mesh = trimesh.load_mesh(stl_file)
+        # Load the mesh from the STL file, or take the mesh tessellated in memory (PartCreator.to_mesh)
+        mesh = stl_file if isinstance(stl_file, trimesh.Trimesh) else trimesh.load_mesh(stl_file)
 
         # Compute the voxel grid
-        voxel_grid = mesh.voxelized(pitch=1, method='binvox').matrix
-        voxel_grid = binary_fill_holes(voxel_grid)
-        bbox = mesh.bounding_box.extents
-        voxel_grid = voxel_grid[0:int(bbox[0]), 0:int(bbox[1]), 0:int(bbox[2])]
-        resolution = self.voxel_resolution
-        pad = [
-            ((resolution[0] - voxel_grid.shape[0]) // 2, (resolution[0] - voxel_grid.shape[0] ) // 2 + (resolution[0] - voxel_grid.shape[0]) % 2),
-            ((resolution[1] - voxel_grid.shape[1]) // 2, (resolution[1] - voxel_grid.shape[1] ) // 2 + (resolution[1] - voxel_grid.shape[1]) % 2),
-            ((resolution[2] - voxel_grid.shape[2]) // 2, (resolution[2] - voxel_grid.shape[2] ) // 2 + (resolution[2] - voxel_grid.shape[2]) % 2)
-        ]
-        self.voxels = np.pad(voxel_grid, pad, mode='constant', constant_values=False)
+        if bounds is None or self.method != 'scanline' or not self.update_region(mesh, bounds):
+            self.region = None
+            get_telemetry().count('full voxelization')
+            if self.method == 'scanline':
+                # Filled solid already cropped to the part extents
+                voxel_grid = voxelize_mesh(mesh)
+            else:
+                voxel_grid = mesh.voxelized(pitch=1, method='binvox').matrix
+                voxel_grid = binary_fill_holes(voxel_grid)
+                bbox = mesh.bounding_box.extents
+                voxel_grid = voxel_grid[0:int(bbox[0]), 0:int(bbox[1]), 0:int(bbox[2])]
+            self.grid_bounds = mesh.bounds.copy()
+            self.grid_shape = voxel_grid.shape
+            self.padding = get_padding(voxel_grid.shape, self.voxel_resolution)
+            pad_to_resolution(voxel_grid, self.voxel_resolution, out=self.voxels)
+            del voxel_grid
+        self.mesh_volume = mesh.volume
 
         if operation is not None:
-            # Store the voxel grid directly to the HDF5 file
+            # Buffer the voxel grid for the HDF5 file
             self.append_to_h5file(self.voxels, operation)
 
-        # Release memory
         del mesh
-        del voxel_grid
-        del pad
-        gc.collect()
+        self.release_memory()
+
+    def update_region(self, mesh, bounds):
+        # Voxelize again only the columns under the given bounds and paste them in the last grid.
+        # Returns False when the result cannot be trusted (the grid would move or material would be added)
+        if self.last_voxels is None or self.grid_bounds is None or not np.allclose(mesh.bounds, self.grid_bounds):
+            return False
+        origin = self.grid_bounds[0]
+        start = np.clip(np.floor(bounds[0, :2] - origin[:2]).astype(int) - 1, 0, self.grid_shape[:2]) # One column of margin
+        end = np.clip(np.ceil(bounds[1, :2] - origin[:2]).astype(int) + 1, 0, self.grid_shape[:2])
+        if np.any(end <= start):
+            return False
+        columns = voxelize_mesh(mesh, self.grid_shape, columns=(start[0], end[0], start[1], end[1]))
+
+        offsets = [before for before, _ in self.padding]
+        region = (slice(offsets[0] + start[0], offsets[0] + end[0]), slice(offsets[1] + start[1], offsets[1] + end[1]),
+                  slice(offsets[2], offsets[2] + self.grid_shape[2]))
+        previous = self.last_voxels[region]
+        if np.any(columns & ~previous): # Machining only removes material
+            return False
+        # The removed voxels must account for the removed volume, otherwise the bounds missed part of the change
+        removed_volume = self.mesh_volume - mesh.volume
+        removed_voxels = np.count_nonzero(previous) - np.count_nonzero(columns)
+        if abs(removed_voxels - removed_volume) > 0.25 * removed_volume + 8:
+            return False
+        get_telemetry().count('incremental voxelization')
+        np.copyto(self.voxels, self.last_voxels)
+        self.voxels[region] = columns
+        self.region = region
+        return True
 
+    @timed('delta')
     def compute_delta_volume(self, operation=None):
         if self.last_voxels is None or self.voxels is None:
             raise ValueError("Voxel grids must be initialized.")
@@ -66,77 +221,88 @@ class VoxelConverter:
         if self.last_voxels.shape != self.voxels.shape:
             raise ValueError("Voxel grids must have the same shape.")
 
-        # Compute the difference between the two voxel grids (XOR operation)
-        delta_voxels = np.logical_xor(self.last_voxels, self.voxels)
+        # Compute the difference between the two voxel grids (XOR operation), only inside the updated region if any
+        # The result is written into the delta buffer, which is overwritten by the next call
+        delta_voxels = self.delta_voxels
+        if self.region is not None:
+            delta_voxels[...] = False
+            np.logical_xor(self.last_voxels[self.region], self.voxels[self.region], out=delta_voxels[self.region])
+        else:
+            np.logical_xor(self.last_voxels, self.voxels, out=delta_voxels)
 
         if operation is not None:
-            # Store the delta voxel grid directly to the HDF5 file
+            # Buffer the delta voxel grid for the HDF5 file
             self.append_to_h5file(delta_voxels, operation)
+        self.release_memory()
+        return delta_voxels
 
-        # Release memory
-        del delta_voxels
-        gc.collect()
+    def remove_sample(self):
+        # Remove matching STL files
+        stl_dirpath = os.path.dirname(self.stl_filename)
+        stl_basename = os.path.basename(self.stl_filename)[:-7]
+        pattern = f'{stl_basename}_??.stl'
+        stl_files = glob.glob(os.path.join(stl_dirpath, pattern))
+        for stl_file in stl_files:
+            os.remove(stl_file)
+        print(f"Removed {stl_basename} files.")
 
-    def finalize(self, augmentation=False, base_h5_dir=None, base_stl_dir=None):
+    @timed('finalize')
+    def finalize(self, augmentation=False, base_h5_dir=None, base_stl_dir=None, allocator=None, rotations=None, transaction=None):
+        # augmentation: False, True (one file per rotation) or 'virtual' (the rotation codes are stored in the
+        # sample file and applied by SequenceReader at load time)
         repeat_sample = False
+        rotations = rotations if rotations is not None else LEGACY_ROTATIONS
         # Store the last voxel grid (final part shape)
         if self.voxels is not None:
             self.append_to_h5file(self.voxels, FP_IDX)
-            del self.voxels
-
-        if augmentation:
-            rotations = [
-                lambda x: np.rot90(x, 1, axes=(0, 1)),  # Rotate 90 degrees around axes (0, 1)
-                lambda x: np.rot90(x, 1, axes=(1, 2)),  # Rotate 90 degrees around axes (1, 2)
-                lambda x: np.rot90(x, 1, axes=(2, 0)),  # Rotate 90 degrees around axes (2, 0)
-                lambda x: np.rot90(x, 2, axes=(0, 1)),  # Rotate 180 degrees around axes (0, 1)
-                lambda x: np.rot90(x, 2, axes=(1, 2))   # Rotate 180 degrees around axes (1, 2)
-            ]
-
-            with h5py.File(self.filename, 'r') as h5file:
-                voxels_dataset = h5file['voxels']
-                operations_dataset = h5file['operations']
-
-                for idx, rotation in enumerate(rotations):
-                    new_filename, _ = get_next_filenames(base_h5_dir, base_stl_dir, max_files_per_folder=3000)
+            self.voxels = None
+            self.last_voxels = None
+        frames, operations = self.writer.get_sequence()
+        self.writer.clear()
+        orientations = [0] + list(rotations) if augmentation == 'virtual' else None
+
+        # Validate the sample before writing anything (rotations keep the voxel counts, so once is enough)
+        if transaction is not None:
+            transaction.add_sequence(frames, operations, orientations)
+            reason = transaction.validate(self.voxel_resolution)
+        else:
+            reason = validate_sequence(frames, operations, self.voxel_resolution)
+        get_telemetry().set(frames=len(frames))
+        if reason is not None:
+            print(f"Error in the h5 file: {reason}")
+            get_telemetry().repeat(reason)
+            if transaction is not None:
+                transaction.abort()
+            else:
+                self.remove_sample()
+            repeat_sample = True
+            return repeat_sample
+
+        # Rotate the whole (T, X, Y, Z) stack in one call per orientation
+        sequences = [(frames, orientations)]
+        if augmentation and augmentation != 'virtual':
+            sequences.extend((rotate_frames(frames, rotation), None) for rotation in rotations)
+
+        if transaction is not None:
+            # Staged STL and HDF5 files are moved into the tree together (the first sequence is already added)
+            for sequence, sequence_orientations in sequences[1:]:
+                transaction.add_sequence(sequence, operations, sequence_orientations)
+            transaction.commit(self.writer)
+            self.written_files.extend(transaction.h5_files)
+            self.filename = transaction.h5_files[-1]
+            get_telemetry().add_files(transaction.stl_files)
+        else:
+            for k, (sequence, sequence_orientations) in enumerate(sequences):
+                if k > 0:
+                    if allocator is not None:
+                        new_filename, _ = allocator.next_filenames()
+                    else:
+                        new_filename, _ = get_next_filenames(base_h5_dir, base_stl_dir, max_files_per_folder=3000)
                     self.filename = new_filename
-                    
-                    for i in range(voxels_dataset.shape[0]):
-                        try:
-                            voxel_rotated = rotation(voxels_dataset[i])
-                            operation = operations_dataset[i]
-                            if np.count_nonzero(voxel_rotated) <= 200:
-                                raise ValueError("Voxel grid is empty after rotation.")
-                            self.append_to_h5file(voxel_rotated, operation)
-                            del voxel_rotated
-                            gc.collect()
-
-                        except Exception as e:
-                            print(f"Error in the h5 file: {e}")
-                            h5file.close()
-                            base_number = int(self.filename[-11:-3])
-
-                            # Remove matching STL files
-                            stl_dirpath = os.path.dirname(self.stl_filename)
-                            stl_basename = str(base_number - (idx + 1)).zfill(8)
-                            pattern = f'{stl_basename}_??.stl'
-                            stl_files = glob.glob(os.path.join(stl_dirpath, pattern))
-                            for stl_file in stl_files:
-                                os.remove(stl_file)
-
-                            # Remove matching HDF5 files
-                            for n in range(idx + 2):
-                                try:
-                                    filename_remove = self.filename[:-11] + str(base_number - n).zfill(8) + '.h5'
-                                    os.remove(filename_remove)
-                                except FileNotFoundError:
-                                    continue
-                            
-                            print(f"Removed {stl_basename} files.")
-                            repeat_sample = True
-                            return repeat_sample
-                     
-        gc.collect()            
-        return repeat_sample
+                self.writer.write(self.filename, sequence, operations, orientations=sequence_orientations)
+                self.written_files.append(self.filename)
 
-               
\ No newline at end of file
+        get_telemetry().add_files(self.written_files)
+        del frames, sequences
+        self.release_memory()
+        return repeat_sample
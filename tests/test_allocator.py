@@ -0,0 +1,21 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from scripts.utils import SampleAllocator
+
+def allocate(base_dir, count):
+    allocator = SampleAllocator(os.path.join(base_dir, 'seq_h5'), os.path.join(base_dir, 'seq_stl'), block_size=1)
+    return [allocator.next_sample_id() for _ in range(count)]
+
+def test_concurrent_allocators_hand_out_unique_ids(tmp_path):
+    # Several processes share the counter of one tree; every id must be handed out exactly once
+    num_workers, count = 4, 50
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(allocate, str(tmp_path), count) for _ in range(num_workers)]
+        ids = [sample_id for future in futures for sample_id in future.result()]
+    assert sorted(ids) == list(range(num_workers * count))
+
+def test_lock_is_released_after_reserve(tmp_path):
+    allocator = SampleAllocator(str(tmp_path / 'seq_h5'), str(tmp_path / 'seq_stl'), block_size=5)
+    assert allocator.reserve(5) == (0, 5)
+    assert allocator.lock_file is None
+    assert SampleAllocator(str(tmp_path / 'seq_h5'), str(tmp_path / 'seq_stl'), lock_timeout=1).reserve(3) == (5, 8)
@@ -0,0 +1,23 @@
+import numpy as np
+from scripts.macro import *
+from scripts.storage import SequenceWriter
+from scripts.rotations import rotate_frames
+from scripts.loader import SequenceLoader
+
+LEGACY_CODES = [0, 10, 5, 20, 3, 1]
+
+def test_orientations_yield_the_stored_rotation_codes(tmp_path):
+    # The items hold the rotation codes of the file, not their positions in the orientations attribute
+    rng = np.random.default_rng(0)
+    frames = rng.random((3, 8, 8, 8)) < 0.5
+    operations = np.array([RS_IDX, MILL_IDX, DRILL_IDX])
+    (tmp_path / '0000').mkdir()
+    SequenceWriter().write(str(tmp_path / '0000' / '00000000.h5'), frames, operations, orientations=LEGACY_CODES)
+    with SequenceLoader(base_h5_dir=str(tmp_path), batch_size=len(LEGACY_CODES), shuffle=False, num_workers=0,
+                        orientations=True) as loader:
+        assert [code for _, code in loader.items] == LEGACY_CODES
+        batch, batch_operations, mask = next(iter(loader))
+    for row, code in enumerate(LEGACY_CODES):
+        assert np.array_equal(batch[row, :3], rotate_frames(frames, code))
+        assert np.array_equal(batch_operations[row, :3], operations)
+        assert mask[row].sum() == 3
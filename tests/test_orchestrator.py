@@ -0,0 +1,24 @@
+import random
+from scripts.orchestrator import read_manifest, run_worker, get_sample_seed
+from scripts.planner import plan_sample, write_plan_manifest
+
+def test_worker_builds_samples_from_the_plan_manifest(tmp_path):
+    # Samples 1-3 are in the manifest; the first plan of sample 1 is rejected and sample 5 is not covered
+    plan_manifest = str(tmp_path / 'plans.h5')
+    write_plan_manifest(plan_manifest, 3, base_seed=7, num_workers=1)
+    calls = []
+
+    def generate_sample(sample, plan):
+        calls.append((sample, plan))
+        return sample == 1 and len(calls) == 1
+
+    task = {'worker': 0, 'run_dir': str(tmp_path), 'base_seed': 7, 'max_attempts': 3, 'samples': [1, 2, 5],
+            'plan_manifest': plan_manifest}
+    run_worker(generate_sample, task)
+    assert [sample for sample, _ in calls] == [1, 1, 2, 5]
+    stock, feature_list, _, _ = plan_sample(random.Random(get_sample_seed(7, 2)))
+    assert calls[2][1] == (tuple(stock), feature_list)
+    assert calls[0][1] is not None and calls[1][1] is None and calls[3][1] is None
+    records = read_manifest(str(tmp_path))
+    assert [records[sample]['status'] for sample in [1, 2, 5]] == ['done'] * 3
+    assert records[1]['attempt'] == 1
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from scripts.storage import SequenceWriter, SequenceReader, downsample_frames
+
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'sparse'])
+@pytest.mark.parametrize('mode', ['any', 'fraction'])
+def test_pyramid_levels_round_trip(tmp_path, storage, mode):
+    frames = np.random.default_rng(0).random((3, 16, 16, 16)) < 0.1
+    filename = str(tmp_path / 'sequence.h5')
+    SequenceWriter(storage=storage, pyramid_levels=[2, 4], pyramid_mode=mode).write(filename, frames, [0, 1, 2])
+    for factor in [2, 4]:
+        with SequenceReader(filename, level=factor) as reader:
+            expected = downsample_frames(frames, factor, mode)
+            if mode == 'fraction':
+                expected = expected.astype(np.float32) / 255
+            assert reader.storage == ('packed' if mode == 'any' and storage != 'dense' else 'dense')
+            assert np.array_equal(reader.read_batch(), expected)
@@ -0,0 +1,31 @@
+import random
+import numpy as np
+import pytest
+from scripts.utils import SurfaceMap
+
+def get_table(grid):
+    table = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(grid, axis=0, dtype=np.int64), axis=1)
+    return table
+
+def get_free_windows(grid, h, w, margin):
+    length, width = grid.shape
+    return np.array([[not grid[max(i - margin, 0):i + h + margin, max(j - margin, 0):j + w + margin].any()
+                      for j in range(width - w + 1)] for i in range(length - h + 1)])
+
+@pytest.mark.parametrize('query_every', [1, 4])
+def test_table_matches_full_rebuild(query_every):
+    # Rectangles (incremental update) mixed with other indices (rebuild), including overwrites and clearing; the
+    # writes between two queries are applied together
+    rng = random.Random(0)
+    for dtype, values in [(bool, [True, False]), (np.int64, [0, 1, 3])]:
+        surface = SurfaceMap(37, 29, dtype=dtype)
+        for k in range(200):
+            i, j = rng.randrange(-40, 40), rng.randrange(-30, 30)
+            key = rng.choice([(slice(i, i + rng.randrange(20)), slice(j, j + rng.randrange(20))), (i % 37, slice(j, None)),
+                              slice(i, None), (slice(None, None, 2), j % 29), (np.array([1, 5, 7]), slice(3, 9))])
+            surface[key] = rng.choice(values)
+            if k % query_every == 0:
+                assert (surface.table == get_table(surface.grid)).all()
+                margin = rng.randrange(3)
+                assert (surface.free_windows(5, 4, margin) == get_free_windows(surface.grid, 5, 4, margin)).all()
@@ -0,0 +1,14 @@
+from scripts.telemetry import Telemetry, summarize
+
+def test_summary_counts_failed_samples(tmp_path):
+    # A sample fails with an exception or, in the orchestrator workers, with status 'failed' after its attempts
+    telemetry = Telemetry(str(tmp_path / 'telemetry.jsonl'))
+    records = []
+    for sample, fields in enumerate([{'status': 'done'}, {'status': 'failed'}, {'error': 'RuntimeError()'}, {}]):
+        telemetry.start_sample(sample)
+        telemetry.repeat('retry')
+        records.append(telemetry.end_sample(**fields))
+    summary = summarize(records)
+    assert summary['samples'] == 4
+    assert summary['failed'] == 2
+    assert summary['repeats'] == {'retry': 4}
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pytest
+from scripts.macro import *
+from scripts.storage import SequenceWriter
+from scripts.shards import list_sample_files
+from scripts.transaction import SampleTransaction
+
+RESOLUTION = (16, 16, 16)
+
+def get_sequence():
+    # Raw stock, one mill and the final part, each with enough voxels to pass the validation
+    frames = np.zeros((3,) + RESOLUTION, dtype=bool)
+    frames[0, 2:14, 2:14, 2:14] = True
+    frames[1, 2:14, 2:14, 10:14] = True
+    frames[2] = frames[0] & ~frames[1]
+    return frames, np.array([RS_IDX, MILL_IDX, FP_IDX])
+
+def stage_stl(transaction):
+    with open(transaction.stl_filename, 'w') as f:
+        f.write('solid sample')
+
+class FailingWriter:
+    def write(self, filename, *args, **kwargs):
+        open(filename, 'w').close()
+        raise OSError("Disk full")
+
+def test_validate(tmp_path):
+    with SampleTransaction(str(tmp_path / 'seq_h5'), str(tmp_path / 'seq_stl')) as transaction:
+        assert transaction.validate(RESOLUTION) == "No sequence to commit."
+        frames, operations = get_sequence()
+        transaction.add_sequence(frames, operations)
+        assert transaction.validate(RESOLUTION) is None
+        transaction.add_sequence(np.zeros_like(frames), operations)
+        assert "empty" in transaction.validate(RESOLUTION)
+
+def test_commit_and_abort_leave_no_gaps_or_staged_files(tmp_path):
+    base_h5_dir, base_stl_dir = str(tmp_path / 'seq_h5'), str(tmp_path / 'seq_stl')
+    frames, operations = get_sequence()
+    with SampleTransaction(base_h5_dir, base_stl_dir) as transaction:
+        stage_stl(transaction)
+        transaction.add_sequence(frames, operations)
+        transaction.add_sequence(frames[:, ::-1], operations)
+        transaction.commit(SequenceWriter())
+    with SampleTransaction(base_h5_dir, base_stl_dir) as transaction: # Rejected sample
+        stage_stl(transaction)
+    with SampleTransaction(base_h5_dir, base_stl_dir) as transaction: # Write error
+        transaction.add_sequence(frames, operations)
+        with pytest.raises(OSError):
+            transaction.commit(FailingWriter())
+    with SampleTransaction(base_h5_dir, base_stl_dir) as transaction:
+        transaction.add_sequence(frames, operations)
+        transaction.commit(SequenceWriter())
+    names = [os.path.basename(filename) for filename in list_sample_files(base_h5_dir)]
+    assert names == ['00000000.h5', '00000001.h5', '00000002.h5']
+    assert os.listdir(os.path.join(base_stl_dir, '0000')) == ['00000000_00.stl']
+    assert not [f for f in os.listdir(base_h5_dir) + os.listdir(base_stl_dir) if f.startswith('.stage_')]
+
+def test_stale_staging_entries_are_removed(tmp_path):
+    base_h5_dir, base_stl_dir = tmp_path / 'seq_h5', tmp_path / 'seq_stl'
+    stale = [base_stl_dir / '.stage_crashed', base_h5_dir / '.stage_crashed', base_h5_dir / '0000' / '00000005.h5.tmp']
+    for path in stale[:2]:
+        path.mkdir(parents=True)
+    stale[2].parent.mkdir()
+    stale[2].write_bytes(b'')
+    live = base_stl_dir / '.stage_live'
+    live.mkdir()
+    for path in stale:
+        os.utime(path, (0, 0))
+    with SampleTransaction(str(base_h5_dir), str(base_stl_dir)):
+        assert not any(path.exists() for path in stale)
+        assert live.exists()